@@ -37,7 +37,9 @@ def create_app(config_class=Config):
     cache.init_app(app)
     db.init_app(app)
     login.init_app(app)
-    migrate.init_app(app, db)
+    from app import search
+
+    migrate.init_app(app, db, include_name=search.include_name)
 
     from app.alias import bp as alias_bp
 
@@ -1,24 +1,31 @@
 import datetime as dt
 import functools
 import json
-import os
 
 from flask import (
-    after_this_request,
     flash,
     redirect,
     request,
     render_template,
-    send_file,
+    Response,
     url_for,
 )
 from flask_login import login_required
 
-from app import db, cache
+from app import db, cache, search, totals
 from app.alias import bp
 from app.alias.forms import DeleteAlias, NewAliasName, UpdateAlias, JSONForm
-from app.main.routes import check_donation_records
-from app.models import Donor, DonorAlias
+from app.main.routes import check_donation_records, versioned
+from app.models import DatasetState, Donor, DonorAlias
+
+
+def aliases_changed(*aliases):
+    """Brings everything derived from aliases up to date after a change to aliases, or
+    to all of them if none are given. To be committed along with the change."""
+    db.session.flush()
+    search.sync(DonorAlias)
+    totals.rebuild([alias.id for alias in aliases] if aliases else None)
+    DatasetState.bump()
 
 
 @bp.route("/aliases", methods=["GET"])
@@ -97,12 +104,14 @@ def new_alias():
                     selected_donors=request.args.get("selected_donors"),
                 )
             )
+        previous_aliases = [donor.donor_alias for donor in selected_donors]
         alias = DonorAlias(
             name=form.alias_name.data,
             note=form.note.data,
             donors=selected_donors,
         )
         db.session.add(alias)
+        aliases_changed(alias, *previous_aliases)
         db.session.commit()
         flash("New donor alias added!")
         return redirect(url_for("alias.aliases"))
@@ -130,6 +139,7 @@ def alias(id):
             return redirect(url_for("alias.aliases", id=id))
         alias.name = form.alias_name.data or alias.name or None
         alias.note = form.note.data or alias.note or None
+        aliases_changed(alias)
         db.session.commit()
         flash("Alias updated!")
     elif request.method == "GET":  # pragma: no cover
@@ -146,11 +156,14 @@ def delete_alias(id):
     form = DeleteAlias()
     if form.validate_on_submit():
         # Re-create aliases for donors linked to the alias so they are not orphaned
+        new_aliases = []
         for donor in alias.donors:
             new_alias = DonorAlias(name=donor.name)
             new_alias.donors.append(donor)
             db.session.add(new_alias)
+            new_aliases.append(new_alias)
         # No need to delete the alias, because the last donor left will have its own alias
+        aliases_changed(alias, *new_aliases)
         db.session.commit()
         flash(f"Alias {alias.name} deleted!")
         return redirect(url_for("alias.aliases"))
@@ -166,18 +179,22 @@ def remove_alias(alias_id, donor_id):
     form = DeleteAlias()
     full_delete = True if (alias.name == donor.name) else False
     if form.validate_on_submit():
+        new_aliases = []
         if full_delete:
             for donor in alias.donors:  # pragma: no cover
                 new_alias = DonorAlias(name=donor.name)
                 new_alias.donors.append(donor)
                 db.session.add(new_alias)
+                new_aliases.append(new_alias)
             flash(f"{alias.name} deleted!")  # pragma: no cover
         else:
             alias.donors.remove(donor)
             new_alias = DonorAlias(name=donor.name)
             new_alias.donors.append(donor)
             db.session.add(new_alias)
+            new_aliases.append(new_alias)
             flash(f"Donor {donor.name} removed from alias {alias.name}!")
+        aliases_changed(alias, *new_aliases)
         db.session.commit()
         return redirect(url_for("alias.aliases"))
     return render_template(
@@ -191,6 +208,7 @@ def remove_alias(alias_id, donor_id):
 
 
 @bp.route("/export", methods=["GET"])
+@versioned
 def export_aliases():
     """Export all aliases ready to be reimported."""
     all_alias_query = (
@@ -211,15 +229,11 @@ def export_aliases():
         + dt.datetime.now().strftime("%Y-%m-%d")
         + ".json"
     )
-    with open("app/" + filename, "w") as writer:
-        writer.write(export_data)
-
-    @after_this_request
-    def remove_file(response):
-        os.remove("app/" + filename)
-        return response
-
-    return send_file(filename, as_attachment=True, mimetype="json")
+    return Response(
+        export_data,
+        mimetype="application/json",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
 
 @bp.route("/import", methods=["GET", "POST"])
@@ -247,6 +261,7 @@ def import_aliases():
                 if donor_record is not None:
                     new_alias.donors.append(donor_record)  # pragma: no cover
             db.session.add(new_alias)
+        aliases_changed()
         db.session.commit()
         cache.clear()
         return redirect(url_for("alias.aliases"))
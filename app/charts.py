@@ -0,0 +1,72 @@
+import functools
+import hashlib
+import json
+
+import orjson
+import plotly.io as pio
+
+from app import cache
+from app.models import DatasetState
+
+# Charts are built as plain dicts rather than plotly.graph_objects, which validate every
+# property as it's set. Properties are kept in the order Plotly would give them, so that
+# to_json() returns the same text as go.Figure(figure).to_json().
+FONT = {
+    "color": "rgba(255,255,255,255)",
+    "family": "'Helvetica Neue', 'Open Sans', Arial",
+}
+
+# Plotly escapes these so that its JSON can be inlined in a <script> tag
+UNSAFE_CHARACTERS = {
+    "<": "\\u003c",
+    ">": "\\u003e",
+    "/": "\\u002f",
+    "\u2028": "\\u2028",
+    "\u2029": "\\u2029",
+}
+
+
+@functools.cache
+def template(name):
+    return pio.templates[name].to_plotly_json()
+
+
+def trace(type, **properties):
+    """A trace of type, with its properties sorted as Plotly sorts them"""
+    return {**dict(sorted(properties.items())), "type": type}
+
+
+def figure(data, **layout):
+    """A figure with data's traces and layout's properties, sorted, followed by Plotly's
+    default template. Nested layout properties should be given in alphabetical order."""
+    layout = dict(sorted(layout.items()))
+    layout["template"] = template(pio.templates.default)
+    return {"data": data, "layout": layout}
+
+
+def to_json(figure):
+    """Serialises a figure from figure() as Plotly's to_json() would"""
+    text = orjson.dumps(
+        figure, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    ).decode("utf-8")
+    for character, escaped in UNSAFE_CHARACTERS.items():
+        if character in text:
+            text = text.replace(character, escaped)
+    return text
+
+
+def cached(func):
+    """Caches what func returns, usually chart JSON, by its name and arguments and the
+    dataset version, so that repeat views of a page don't rebuild its charts"""
+
+    @functools.wraps(func)
+    def decorated_function(*args):
+        key = json.dumps([DatasetState.current().version, func.__qualname__, args])
+        key = "chart/" + hashlib.sha256(key.encode("utf-8")).hexdigest()
+        result = cache.get(key)
+        if result is None:
+            result = func(*args)
+            cache.set(key, result, timeout=600000)
+        return result
+
+    return decorated_function
@@ -0,0 +1,47 @@
+from datetime import date
+import functools
+import gzip
+import json
+
+from app.db_import.normalise import COLUMNS
+
+# Normalised batches are archived one per line, as gzipped JSON objects mapping each of
+# COLUMNS to its list of values, so they can be imported again without parsing and
+# cleaning the raw CSV
+SUFFIX = ".jsonl.gz"
+DATE_COLUMNS = ["deregistered", "date"]
+
+
+def is_archive(filename):
+    return filename.endswith(SUFFIX)
+
+
+def encode_batch(batch, rows):
+    """Serialises a batch from normalise_batch as one archive line. rows is the number of
+    raw records it was normalised from."""
+    line = {column: batch[column] for column in COLUMNS}
+    for column in DATE_COLUMNS:
+        line[column] = [value.isoformat() if value else None for value in batch[column]]
+    line["rows"] = rows
+    return (json.dumps(line, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+@functools.cache
+def parse_iso_date(value):
+    return date.fromisoformat(value) if value else None
+
+
+def decode_batch(line):
+    """Returns the batch in an archive line together with its number of raw records"""
+    batch = json.loads(line)
+    for column in DATE_COLUMNS:
+        batch[column] = [parse_iso_date(value) for value in batch[column]]
+    return batch, batch.pop("rows")
+
+
+def read_archive(fileobj):
+    """Yields each batch in an archive file, with its number of raw records, then closes
+    the file"""
+    with fileobj, gzip.GzipFile(fileobj=fileobj) as infile:
+        for line in infile:
+            yield decode_batch(line)
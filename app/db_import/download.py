@@ -0,0 +1,162 @@
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import csv
+import gzip
+import hashlib
+import http.client
+import io
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+
+PAGE_SIZE = 25000
+# Pages requested at once; the Electoral Commission is a public service, so keep it low
+WORKERS = 4
+RETRIES = 3
+BACKOFF = 2
+TIMEOUT = 120
+
+
+def fetch_page(url, retries=RETRIES, backoff=BACKOFF):
+    """Fetches a single page, retrying with exponential backoff after network errors and
+    server errors. Client errors are raised straight away."""
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(url, timeout=TIMEOUT) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code < 500 or attempt == retries:
+                raise
+        except (OSError, http.client.HTTPException):
+            if attempt == retries:  # pragma: no cover
+                raise
+        time.sleep(backoff * 2**attempt)
+
+
+def count_rows(page):
+    """Counts the records in a page, excluding its header. Cells can contain line breaks,
+    so lines can't simply be counted."""
+    return max(sum(1 for _ in csv.reader(io.StringIO(page.decode("utf-8")))) - 1, 0)
+
+
+class PagedDownload(io.RawIOBase):
+    """Downloads the CSV a page at a time on background threads, so the download carries
+    on while earlier records are being written to the database. Pages are fetched
+    concurrently, retried individually and reassembled in order, with the header kept
+    from the first page only. Paging stops at an empty page, or at a page shorter than
+    the ones before it. A first page shorter than page_size may have been capped by the
+    server, so paging carries on in pages of that size. URLs without a {start} field
+    are fetched once.
+    Each page is teed to a file for auditing as it is reassembled, compressed if the
+    filename ends with .gz, and hashed. Paging begins at record start, so an interrupted
+    download can be resumed. Wrap in io.TextIOWrapper to feed a CSV reader."""
+
+    def __init__(
+        self,
+        url,
+        filename,
+        page_size=PAGE_SIZE,
+        workers=WORKERS,
+        retries=RETRIES,
+        backoff=BACKOFF,
+        expected_size=0,
+        start=0,
+    ):
+        self.expected_size = expected_size
+        self.bytes_read = 0
+        self.pages = queue.Queue(maxsize=workers)
+        self.leftover = b""
+        self.finished = False
+        # Complete once the stream has been read to the end
+        self.sha256 = hashlib.sha256()
+        self.thread = threading.Thread(
+            target=self._download,
+            args=(url, filename, page_size, workers, retries, backoff, start),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def _download(self, url, filename, page_size, workers, retries, backoff, start):
+        try:
+            # A URL without a {start} field serves every record at once
+            paged = "{start}" in url
+            opener = gzip.open if filename.endswith(".gz") else open
+            with ThreadPoolExecutor(max_workers=workers) as executor, opener(
+                filename, "wb"
+            ) as tee:
+                in_flight = collections.deque()
+                next_start = start
+                first_page = True
+                largest = 0
+                while True:
+                    while len(in_flight) < (workers if paged else 1):
+                        page_url = url.format(start=next_start, page_size=page_size)
+                        in_flight.append(
+                            (
+                                next_start,
+                                executor.submit(fetch_page, page_url, retries, backoff),
+                            )
+                        )
+                        next_start += page_size
+                    page_start, future = in_flight.popleft()
+                    page = future.result()
+                    rows = count_rows(page)
+                    if not first_page:
+                        page = page[page.index(b"\n") + 1 :] if b"\n" in page else b""
+                    if page and not page.endswith(b"\n"):
+                        page += b"\n"
+                    if page:
+                        tee.write(page)
+                        self.sha256.update(page)
+                        self.pages.put(page)
+                    first_page = False
+                    if not paged or rows == 0 or rows < largest:
+                        break
+                    largest = rows
+                    if rows < page_size:
+                        # Either this is the only page, or the server caps pages at this
+                        # many records. Carry on in pages of this size from the end of
+                        # this one, so no records are skipped, until an empty page.
+                        for _, future in in_flight:
+                            future.cancel()
+                        in_flight.clear()
+                        page_size = rows
+                        next_start = page_start + rows
+                for _, future in in_flight:
+                    future.cancel()
+            self.pages.put(b"")
+        except Exception as e:
+            self.pages.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.leftover and not self.finished:
+            page = self.pages.get()
+            if isinstance(page, Exception):
+                raise page
+            self.finished = page == b""
+            self.leftover = page
+        size = min(len(buffer), len(self.leftover))
+        buffer[:size] = self.leftover[:size]
+        self.leftover = self.leftover[size:]
+        self.bytes_read += size
+        return size
+
+    def progress(self):
+        """Fraction of the expected size read so far, or 0 if no size was expected"""
+        if not self.expected_size:
+            return 0
+        return min(self.bytes_read / self.expected_size, 1)
+
+
+def open_csv_stream(url, filename, **kwargs):
+    """Starts downloading url, a template with {start} and {page_size} fields unless it
+    serves every record at once, to filename. Returns the download together with a text
+    stream over it for csv.DictReader."""
+    download = PagedDownload(url, filename, **kwargs)
+    text = io.TextIOWrapper(io.BufferedReader(download), encoding="utf-8", newline="")
+    return download, text
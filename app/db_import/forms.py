@@ -3,4 +3,7 @@ from wtforms import SubmitField
 
 class DBImport(FlaskForm):
     submit = SubmitField("Import data from Electoral Commission")
+    incremental = SubmitField("Import new donations only")
+    reimport = SubmitField("Import the last download again")
+    abandon = SubmitField("Abandon the interrupted import")
     
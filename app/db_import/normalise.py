@@ -0,0 +1,175 @@
+from datetime import datetime
+import functools
+import re
+
+# Columns of a normalised batch, in the order rows are unpacked by the importer
+COLUMNS = [
+    "ec_ref",
+    "recipient",
+    "deregistered",
+    "donor",
+    "donor_id",
+    "postcode",
+    "company_registration_number",
+    "donor_type",
+    "donation_type",
+    "value",
+    "date",
+    "is_legacy",
+]
+
+DONATION_TYPES = [
+    "Cash",
+    "Non Cash",
+    "Visit",
+    "Public Funds",
+    "Exempt Trust",
+    "Impermissible Donor",
+    "Unidentified Donor",
+]
+
+# Recipients with their own filters. All the others are filtered together as "other".
+FILTER_PARTIES = [
+    "Labour Party",
+    "Conservative and Unionist Party",
+    "Liberal Democrats",
+    "Scottish National Party (SNP)",
+    "Green Party",
+    "Reform UK",
+]
+
+DONOR_TYPES = [
+    "Individual",
+    "Company",
+    "Registered Political Party",
+    "Unincorporated Association",
+    "Other",
+    "Trade Union",
+    "Building Society",
+    "Public Fund",
+    "Limited Liability Partnership",
+    "Trust",
+    "Friendly Society",
+    "Impermissible Donor",
+    "N/A",
+    "Unidentifiable Donor",
+]
+
+
+@functools.cache
+def relevant_reporting_period(reporting_period):
+    reporting_period = reporting_period.lower()
+    return not (
+        "referendum" in reporting_period
+        or "election" in reporting_period
+        or "poll" in reporting_period
+    )
+
+
+def remove_line_break(cell):
+    if cell.strip() != "TRUE" and cell.strip() != "FALSE":
+        # If the field doesn't contain "TRUE" or "FALSE", remove any line breaks
+        return cell.replace("\n", " ").replace("\r", "")
+    return cell
+
+
+def clean_column(column):
+    return [
+        remove_line_break(cell) if "\n" in cell or "\r" in cell else cell
+        for cell in column
+    ]
+
+
+# Recipient, donor, donation type and date values repeat throughout the register, so
+# each distinct value is only parsed once
+
+
+@functools.cache
+def parse_recipient(name):
+    """Splits the deregistration date off a recipient's name"""
+    if re.search(r"De-registered", name):
+        deregistered = datetime.strptime(name.split()[-1], "%d/%m/%y]").date()
+        return re.split(r"( \[)", name)[0], deregistered
+    return name, None
+
+
+@functools.cache
+def clean_donor_name(name):
+    """Removes leading/trailing spaces and double spaces"""
+    return name.strip().replace("  ", " ").replace("( ", "(").replace(" )", ")")
+
+
+@functools.cache
+def parse_date(date):
+    return datetime.strptime(date, "%d/%m/%Y").date()
+
+
+@functools.cache
+def clean_donation_type(donation_type):
+    if donation_type == "Permissible Donor Exempt Trust":
+        return "Exempt Trust"
+    return donation_type
+
+
+@functools.cache
+def slugify(name):
+    """The form of a recipient or type name used in filters, e.g.
+    scottish_national_party_snp for Scottish National Party (SNP)"""
+    return name.lower().replace("(", "").replace(")", "").replace(" ", "_")
+
+
+def parse_value(value):
+    value = re.sub(r"[£,]", "", value)
+    return float(value) if value else None
+
+
+def normalise_batch(header, rows):
+    """Takes the CSV header and a list of raw rows. Applies the relevance filter and
+    cleaning rules column by column and returns a dictionary mapping each of COLUMNS to
+    a list of clean, typed values, one per relevant row."""
+    width = len(header)
+    if any(len(row) != width for row in rows):
+        rows = [(row + [""] * width)[:width] for row in rows]
+    columns = dict(zip(header, zip(*rows))) if rows else {field: () for field in header}
+
+    keep = [
+        index
+        for index, (unit, status, action, period) in enumerate(
+            zip(
+                columns["AccountingUnitName"],
+                columns["DonorStatus"],
+                columns["DonationAction"],
+                columns["ReportingPeriodName"],
+            )
+        )
+        if unit == "Central Party"
+        and status != "Unidentifiable Donor"
+        and action not in ("Returned", "Forfeited")
+        and relevant_reporting_period(period)
+    ]
+
+    def column(field):
+        return clean_column([columns[field][index] for index in keep])
+
+    recipients = [parse_recipient(name) for name in column("RegulatedEntityName")]
+    dates = [
+        received or accepted
+        for received, accepted in zip(column("ReceivedDate"), column("AcceptedDate"))
+    ]
+    return {
+        "ec_ref": column("\ufeffECRef"),
+        "recipient": [recipient[0] for recipient in recipients],
+        "deregistered": [recipient[1] for recipient in recipients],
+        "donor": [clean_donor_name(name) for name in column("DonorName")],
+        "donor_id": column("DonorId"),
+        "postcode": column("Postcode"),
+        "company_registration_number": column("CompanyRegistrationNumber"),
+        "donor_type": column("DonorStatus"),
+        "donation_type": [
+            clean_donation_type(donation_type)
+            for donation_type in column("DonationType")
+        ],
+        "value": [parse_value(value) for value in column("Value")],
+        "date": [parse_date(date) for date in dates],
+        "is_legacy": [bequest == "True" for bequest in column("IsBequest")],
+    }
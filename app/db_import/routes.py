@@ -5,13 +5,19 @@ from datetime import datetime
 import glob
 import re
 
+from app import db
 from app.db_import import bp
 from app.db_import.forms import DBImport
+from app.models import ImportCheckpoint, Snapshot
 
 
 def last_download():
-    """Finds last downloaded date"""
-    root_dir = "./tests/" if current_app.config["TESTING"] else "./db/" # pragma: no cover
+    """Finds last downloaded date, from the snapshot manifest or failing that from the
+    names of raw data files saved before snapshots were kept"""
+    snapshot = Snapshot.latest()
+    if snapshot:
+        return snapshot.date.strftime("%d %B %Y")
+    root_dir = current_app.config["RAW_DATA_LOCATION"]
     raw_data_file = glob.glob("raw_data_*.csv", root_dir=root_dir)
     try:
         last_download = re.findall(r"\d{4}\-\d{2}\-\d{2}", raw_data_file[0])
@@ -28,10 +34,24 @@ def dl_and_import():
     form = DBImport()
     if not form.validate_on_submit():
         return render_template(
-            "db_import.html", form=form, last_download=last_download()
+            "db_import.html",
+            form=form,
+            last_download=last_download(),
+            archived=Snapshot.latest(archived=True),
+            checkpoint=ImportCheckpoint.latest(),
         )
     if current_user.get_task_in_progress():  # pragma: no cover
         flash("A database import is currently in progress.")
         return redirect(url_for("main.index"))
-    current_user.launch_task()  # pragma: no cover
+    if form.abandon.data:
+        ImportCheckpoint.abandon()
+        db.session.commit()
+        flash("The interrupted import was abandoned, so the next will start afresh.")
+        return redirect(url_for("db_import.dl_and_import"))
+    if form.reimport.data:  # pragma: no cover
+        current_user.launch_task(snapshot_id=Snapshot.latest(archived=True).id)
+        return redirect(url_for("main.index"))
+    if ImportCheckpoint.latest():  # pragma: no cover
+        flash("Resuming the last database import, which was interrupted.")
+    current_user.launch_task(incremental=form.incremental.data)  # pragma: no cover
     return redirect(url_for("main.index"))  # pragma: no cover
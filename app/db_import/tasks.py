@@ -6,158 +6,249 @@ app.app_context().push()
 from datetime import date, datetime
 from flask import current_app
 import csv
-import re
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
 import rq
 import ssl
 import sys
 import urllib
 
-from app import db, cache
+from sqlalchemy.dialects import sqlite
+
+from app import db, cache, search, totals
+from app.db_import import archive
+from app.db_import.download import open_csv_stream
+from app.db_import.normalise import (
+    COLUMNS,
+    DONATION_TYPES,
+    DONOR_TYPES,
+    normalise_batch,
+    slugify,
+)
 from app.models import (
+    DatasetState,
     Donation,
+    DonationMonth,
     Recipient,
     DonationType,
     Donor,
     DonorAlias,
     DonorType,
+    ImportCheckpoint,
+    ImportWatermark,
+    Snapshot,
     Task,
 )
 
 
-URL = "https://search.electoralcommission.org.uk/api/csv/Donations?start={start}&rows={pageSize}&query=&sort=AcceptedDate&order=desc&et=pp&et=ppm&et=tp&et=perpar&et=rd&date=Received&from=&to=&rptPd=&prePoll=true&postPoll=true&register=gb&register=ni&register=none&donorStatus=individual&donorStatus=tradeunion&donorStatus=company&donorStatus=unincorporatedassociation&donorStatus=publicfund&donorStatus=other&donorStatus=registeredpoliticalparty&donorStatus=friendlysociety&donorStatus=trust&donorStatus=limitedliabilitypartnership&donorStatus=impermissibledonor&donorStatus=na&donorStatus=unidentifiabledonor&donorStatus=buildingsociety&isIrishSourceYes=true&isIrishSourceNo=true&includeOutsideSection75=true"
-
-
-DONATION_TYPES = [
-    "Cash",
-    "Non Cash",
-    "Visit",
-    "Public Funds",
-    "Exempt Trust",
-    "Impermissible Donor",
-    "Unidentified Donor",
-]
-
-DONOR_TYPES = [
-    "Individual",
-    "Company",
-    "Registered Political Party",
-    "Unincorporated Association",
-    "Other",
-    "Trade Union",
-    "Building Society",
-    "Public Fund",
-    "Limited Liability Partnership",
-    "Trust",
-    "Friendly Society",
-    "Impermissible Donor",
-    "N/A",
-    "Unidentifiable Donor",
-]
-
-
-def remove_line_breaks(row):
-    """Removes lines that contain line breaks within cells"""
-    for field in row:
-        if row[field].strip() != "TRUE" and row[field].strip() != "FALSE":
-            # If the field doesn't contain "TRUE" or "FALSE", remove any line breaks
-            row[field] = row[field].replace("\n", " ").replace("\r", "")
-    return row
-
-
-def import_record(record):
-    if (
-        record["AccountingUnitName"] != "Central Party"
-        or record["DonorStatus"] in ["Unidentifiable Donor"]
-        or record["DonationAction"] in ["Returned", "Forfeited"]
-        or "referendum" in record["ReportingPeriodName"].lower()
-        or "election" in record["ReportingPeriodName"].lower()
-        or "poll" in record["ReportingPeriodName"].lower()
-    ):
-        return
-    record = remove_line_breaks(record)
+URL = "https://search.electoralcommission.org.uk/api/csv/Donations?start={start}&rows={page_size}&query=&sort=AcceptedDate&order=desc&et=pp&et=ppm&et=tp&et=perpar&et=rd&date=Received&from={from_date}&to=&rptPd=&prePoll=true&postPoll=true&register=gb&register=ni&register=none&donorStatus=individual&donorStatus=tradeunion&donorStatus=company&donorStatus=unincorporatedassociation&donorStatus=publicfund&donorStatus=other&donorStatus=registeredpoliticalparty&donorStatus=friendlysociety&donorStatus=trust&donorStatus=limitedliabilitypartnership&donorStatus=impermissibledonor&donorStatus=na&donorStatus=unidentifiabledonor&donorStatus=buildingsociety&isIrishSourceYes=true&isIrishSourceNo=true&includeOutsideSection75=true"
+
+
+# Cleaned rows are loaded here, then merged into the real tables with set-based SQL.
+# Temporary tables belong to a connection, so it's (re)created in each transaction.
+staging = db.Table(
+    "donation_staging",
+    db.MetaData(),
+    db.Column("seq", db.Integer, primary_key=True),
+    db.Column("ec_ref", db.String(8)),
+    db.Column("recipient", db.String(100)),
+    db.Column("deregistered", db.Date),
+    db.Column("donor", db.String(100)),
+    db.Column("donor_id", db.String(20)),
+    db.Column("postcode", db.String(7)),
+    db.Column("company_registration_number", db.String(20)),
+    db.Column("donor_type", db.String(25)),
+    db.Column("donation_type", db.String(100)),
+    db.Column("value", db.Float),
+    db.Column("date", db.Date),
+    db.Column("is_legacy", db.Boolean),
+    prefixes=["TEMPORARY"],
+)
 
-    # Recipient
-    if re.search(r"De-registered", record["RegulatedEntityName"]):
-        deregistered = record["RegulatedEntityName"].split()[-1]
-        deregistered = datetime.strptime(deregistered, "%d/%m/%y]")
-        recipient_name = re.split(r"( \[)", record["RegulatedEntityName"])[0]
-    else:
-        recipient_name = record["RegulatedEntityName"]
-        deregistered = None
 
-    query = db.select(Recipient).filter_by(name=recipient_name)
-    if not db.session.execute(query).scalar():
-        recipient = Recipient(name=recipient_name, deregistered=deregistered)
-        db.session.add(recipient)
-        db.session.commit()
-    else:
-        recipient = db.session.execute(query).scalars().first()
-
-    # Clean up donor name to remove leading/trailing spaces and double spaces
-    donor_name = (
-        record["DonorName"]
-        .strip()
-        .replace("  ", " ")
-        .replace("( ", "(")
-        .replace(" )", ")")
-    )
-
-    # Donors and aliases
-    query = db.select(Donor).filter_by(name=donor_name)
-    if db.session.execute(query).scalar():
-        donor = db.session.execute(query).scalars().first()  # pragma: no cover
-    else:
-        new_alias = DonorAlias(name=donor_name)
-        db.session.add(new_alias)
-        db.session.commit()
-        donor = Donor(
-            name=donor_name,
-            ec_donor_id=record["DonorId"],
-            postcode=record["Postcode"],
-            company_registration_number=record["CompanyRegistrationNumber"],
-            donor_type_id=record["DonorStatus"],
+def first_rows(column):
+    """Staging rows holding the first appearance of each value of column"""
+    return db.select(db.func.min(staging.c.seq)).group_by(column)
+
+
+class BulkImporter:
+    """Imports normalised batches of records. Each batch is loaded into a temporary
+    staging table with one executemany INSERT, then merged into the recipient,
+    donor_alias, donor and donation tables with INSERT ... SELECT statements. Unique
+    indexes on recipient and donor names and EC references let SQLite skip rows that are
+    already in the database, so re-imports are idempotent. New rows are inserted in
+    order of first appearance, so IDs match those of a record-by-record import. Given a
+    watermark, records already covered by it are skipped."""
+
+    def __init__(self, watermark=None):
+        self.watermark_date = watermark.date if watermark else None
+        self.watermark_refs = watermark.get_ec_refs() if watermark else set()
+        self.pending = []
+
+    def add_batch(self, batch):
+        """Takes a batch from normalise_batch and queues its rows until the next flush"""
+        for row in zip(*(batch[column] for column in COLUMNS)):
+            row = dict(zip(COLUMNS, row))
+            if self.watermark_date and (
+                row["date"] < self.watermark_date
+                or (
+                    row["date"] == self.watermark_date
+                    and row["ec_ref"] in self.watermark_refs
+                )
+            ):
+                continue
+            self.pending.append(row)
+
+    def flush(self):
+        """Loads pending rows into the staging table and merges them, in one
+        transaction. Any other changes in the session are committed with them."""
+        if not self.pending:
+            db.session.commit()
+            return
+        staging.create(db.session.connection(), checkfirst=True)
+        db.session.execute(staging.insert(), self.pending)
+        self.pending = []
+
+        unknown_types = db.session.scalars(
+            db.select(staging.c.donation_type)
+            .where(staging.c.donation_type.not_in(db.select(DonationType.name)))
+            .distinct()
+        ).all()
+        if unknown_types:
+            raise ValueError(f"Unknown donation types: {unknown_types}")
+
+        recipients = (
+            db.select(staging.c.recipient, staging.c.deregistered)
+            .where(staging.c.seq.in_(first_rows(staging.c.recipient)))
+            .order_by(staging.c.seq)
         )
-        new_alias.donors.append(donor)
-        db.session.add(donor)
-        db.session.commit()
+        db.session.execute(
+            sqlite.insert(Recipient)
+            .from_select(["name", "deregistered"], recipients)
+            .on_conflict_do_nothing()
+        )
+        totals.fill_slugs(Recipient)
 
-    # Donation
-    ec_ref = record["\ufeffECRef"]
-    date = record["ReceivedDate"] or record["AcceptedDate"]
-    date = datetime.strptime(date, "%d/%m/%Y")
+        # Each new donor gets an alias of the same name. The new aliases are told apart
+        # from any existing ones with the same name by their IDs.
+        last_alias_id = db.session.scalar(db.select(db.func.max(DonorAlias.id))) or 0
+        new_donors = staging.c.seq.in_(first_rows(staging.c.donor)) & (
+            staging.c.donor.not_in(db.select(Donor.name))
+        )
+        aliases = (
+            db.select(staging.c.donor, db.literal(datetime.utcnow()))
+            .where(new_donors)
+            .order_by(staging.c.seq)
+        )
+        db.session.execute(
+            db.insert(DonorAlias).from_select(["name", "last_edited"], aliases)
+        )
+        donors = (
+            db.select(
+                DonorAlias.id,
+                staging.c.donor,
+                staging.c.donor_id,
+                staging.c.postcode,
+                staging.c.company_registration_number,
+                staging.c.donor_type,
+            )
+            .join(DonorAlias, DonorAlias.name == staging.c.donor)
+            .where(new_donors)
+            .where(DonorAlias.id > last_alias_id)
+            .order_by(staging.c.seq)
+        )
+        db.session.execute(
+            db.insert(Donor).from_select(
+                [
+                    "donor_alias_id",
+                    "name",
+                    "ec_donor_id",
+                    "postcode",
+                    "company_registration_number",
+                    "donor_type_id",
+                ],
+                donors,
+            )
+        )
 
-    if record["DonationType"] == "Permissible Donor Exempt Trust":
-        query = db.select(DonationType).filter_by(name="Exempt Trust")
-    else:
-        query = db.select(DonationType).filter_by(name=record["DonationType"])
-    donation_type_id = db.session.execute(query).scalar().id
-
-    query = db.select(Donation).filter_by(ec_ref=ec_ref)
-    if not db.session.execute(query).scalar():
-        new_donation = Donation(
-            recipient=recipient,
-            donor=donor,
-            donation_type_id=donation_type_id,
-            value=re.sub(r"[£,]", "", record["Value"]),
-            date=date,
-            ec_ref=ec_ref,
-            is_legacy=record["IsBequest"] == "True",
+        donations = (
+            db.select(
+                Recipient.id,
+                Donor.id,
+                DonationType.id,
+                staging.c.value,
+                staging.c.date,
+                staging.c.ec_ref,
+                staging.c.is_legacy,
+            )
+            .join(Recipient, Recipient.name == staging.c.recipient)
+            .join(Donor, Donor.name == staging.c.donor)
+            .join(DonationType, DonationType.name == staging.c.donation_type)
+            .where(staging.c.seq.in_(first_rows(staging.c.ec_ref)))
+            .order_by(staging.c.seq)
+        )
+        db.session.execute(
+            sqlite.insert(Donation)
+            .from_select(
+                [
+                    "recipient_id",
+                    "donor_id",
+                    "donation_type_id",
+                    "value",
+                    "date",
+                    "ec_ref",
+                    "is_legacy",
+                ],
+                donations,
+            )
+            .on_conflict_do_nothing()
         )
-        db.session.add(new_donation)
+
+        db.session.execute(staging.delete())
         db.session.commit()
 
 
-def download_raw_data():  # pragma: no cover
+def raw_data_url(from_date=None):
+    """Returns the URL for donations received on or after from_date, or all donations if
+    it is None, with its paging fields left for the downloader to fill in"""
+    url = current_app.config["DONATIONS_URL"] or URL
+    return url.format(
+        start="{start}",
+        page_size="{page_size}",
+        from_date=from_date.strftime("%Y-%m-%d") if from_date else "",
+    )
+
+
+def download_raw_data(checkpoint):
+    """Starts downloading the checkpoint's URL a page at a time, from its first
+    uncommitted record. The raw CSV is saved to the checkpoint's snapshot as it
+    arrives."""
     # Ignore SSL certificate errors
     ctx = ssl.create_default_context()
     ctx.check_hostname = False
     ctx.verify_mode = ssl.CERT_NONE
-    filename = "./db/raw_data_" + str(date.today()) + ".csv"
+    # Progress is measured against the size of the last full download
+    expected_size = 0
+    if not checkpoint.incremental and not checkpoint.rows:
+        expected_size = db.session.scalar(
+            db.select(Snapshot.size)
+            .where(Snapshot.incremental == False)
+            .where(Snapshot.size != None)
+            .order_by(Snapshot.id.desc())
+        )
     opener = urllib.request.build_opener()
     opener.addheaders = [("User-agent", "Mozilla/5.0")]
     urllib.request.install_opener(opener)
-    urllib.request.urlretrieve(URL, filename)
-    return filename
+    return open_csv_stream(
+        checkpoint.source,
+        checkpoint.snapshot.raw_filename,
+        expected_size=expected_size or 0,
+        start=checkpoint.rows,
+    )
 
 
 def select_type_list(field):
@@ -173,16 +264,138 @@ def add_missing_entries(field):
     for item in type_list:
         query = db.select(field).filter_by(name=item)
         if not db.session.execute(query).scalar():  # pragma: no cover
-            db.session.add(field(name=item))
+            db.session.add(field(name=item, slug=slugify(item)))
+
+
+class ProgressFile(io.FileIO):
+    """A raw CSV file which reports how far through it reading has got, so progress can
+    be reported during the import's single pass over it"""
+
+    def __init__(self, filename):
+        super().__init__(filename, "rb")
+        self.size = os.fstat(self.fileno()).st_size
+
+    def progress(self):
+        # Buffering reads a few kilobytes ahead of the CSV reader, which doesn't matter
+        return self.tell() / self.size if self.size else 0
+
+
+def open_csv_file(filename):
+    """Returns a raw CSV file together with a text stream over it for csv.DictReader"""
+    raw_file = ProgressFile(filename)
+    text = io.TextIOWrapper(io.BufferedReader(raw_file), encoding="utf-8", newline="")
+    return raw_file, text
+
+
+def csv_batches(infile, batch_size, skip=0):
+    """Yields normalised batches of a raw CSV's records after the first skip, each with
+    the number of raw records it came from"""
+    with infile:
+        reader = csv.reader(infile)
+        header = next(reader)
+        for _ in itertools.islice(reader, skip):
+            pass
+        while rows := list(itertools.islice(reader, batch_size)):
+            yield normalise_batch(header, rows), len(rows)
+
+
+def skip_batches(batches, skip):
+    """Skips the archived batches holding the first skip records"""
+    for batch, rows in batches:
+        if skip > 0:
+            skip -= rows
+            continue
+        yield batch, rows
+
+
+def file_hash(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as infile:
+        while chunk := infile.read(1 << 20):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def can_resume(checkpoint):
+    """A checkpointed import can be resumed from a download, which is fetched again from
+    the first uncommitted record, or from a raw data file that hasn't changed since"""
+    if checkpoint is None:
+        return False
+    if checkpoint.source_hash is None:
+        return True
+    return (
+        os.path.exists(checkpoint.source)
+        and file_hash(checkpoint.source) == checkpoint.source_hash
+    )
 
 
-def count_lines(data):
-    with open(data, newline="") as infile:
-        reader = csv.DictReader(infile)
-        total_records = 0
-        for _ in reader:
-            total_records += 1
-    return total_records
+def start_checkpoint(incremental, snapshot_id=None):
+    """Replaces any previous checkpoint with one for a new import. A download gets a new
+    snapshot."""
+    ImportCheckpoint.abandon()
+    if snapshot_id is not None:
+        source = db.session.get(Snapshot, snapshot_id).archive_filename
+        checkpoint = ImportCheckpoint(source=source, source_hash=file_hash(source))
+        incremental = False
+    elif current_app.config["IMPORT_FILE"]:
+        source = current_app.config["IMPORT_FILE"]
+        checkpoint = ImportCheckpoint(source=source, source_hash=file_hash(source))
+    else:
+        watermark = ImportWatermark.latest() if incremental else None
+        source = raw_data_url(watermark.date if watermark else None)
+        snapshot = Snapshot(date=date.today(), incremental=watermark is not None)
+        db.session.add(snapshot)
+        db.session.flush()
+        filename = (
+            current_app.config["RAW_DATA_LOCATION"]
+            + f"raw_data_{snapshot.date}_{snapshot.id}"
+        )
+        snapshot.raw_filename = filename + ".csv.gz"
+        snapshot.archive_filename = filename + archive.SUFFIX
+        checkpoint = ImportCheckpoint(source=source, snapshot=snapshot)
+    checkpoint.incremental = incremental
+    checkpoint.rows = 0
+    db.session.add(checkpoint)
+    db.session.commit()
+    return checkpoint
+
+
+def resume_snapshot(snapshot, rows):
+    """Prepares the snapshot of an interrupted download to be resumed from record rows.
+    Its raw CSV and archive only hold the records read before the interruption, so they
+    are deleted. The rest of the download is saved to a raw CSV named after the record
+    it starts from, and isn't archived, as the archive would be incomplete."""
+    snapshot.delete_files()
+    stem = snapshot.raw_filename.removesuffix(".csv.gz").split("_from_")[0]
+    snapshot.raw_filename = f"{stem}_from_{rows}.csv.gz"
+    snapshot.archive_filename = None
+
+
+def finish_snapshot(snapshot, download, resumed, previous):
+    """Marks a download's snapshot as imported, unless it's identical to the previous
+    snapshot, in which case it's deleted instead. A resumed download's raw CSV is only
+    partial, so it isn't hashed. Returns whether the download was unchanged."""
+    if not resumed:
+        snapshot.sha256 = download.sha256.hexdigest()
+        snapshot.size = download.bytes_read
+    if previous and snapshot.sha256 and snapshot.sha256 == previous.sha256:
+        os.remove(snapshot.raw_filename)
+        os.remove(snapshot.archive_filename)
+        db.session.delete(snapshot)
+        return True
+    snapshot.imported = True
+    return False
+
+
+def save_watermark():
+    """Records the latest donation date in the database and the EC references on it"""
+    latest = db.session.scalar(db.select(db.func.max(Donation.date)))
+    if latest is None:
+        return
+    ec_refs = db.session.scalars(
+        db.select(Donation.ec_ref).where(Donation.date == latest)
+    ).all()
+    db.session.add(ImportWatermark(date=latest, ec_refs_json=json.dumps(ec_refs)))
 
 
 def _set_task_progress(progress):  # pragma: no cover
@@ -191,6 +404,9 @@ def _set_task_progress(progress):  # pragma: no cover
         job.meta["progress"] = progress
         job.save_meta()
         task = db.session.scalars(db.select(Task).filter_by(id=job.get_id())).first()
+        # The job can start before launch_task has committed its task
+        if task is None:
+            return
         task.user.add_notification(
             "task_progress", {"task_id": job.get_id(), "progress": progress}
         )
@@ -199,35 +415,109 @@ def _set_task_progress(progress):  # pragma: no cover
         db.session.commit()
 
 
-def db_import():
+def update_statistics():
+    """Refreshes SQLite's statistics on its tables and indexes, without which the query
+    planner can't tell, for instance, that sorting donations by recipient is best done by
+    reading recipients in name order"""
+    if db.engine.dialect.name == "sqlite":
+        db.session.execute(db.text("ANALYZE"))
+        db.session.commit()
+
+
+def db_import(incremental=False, snapshot_id=None):
+    """Imports donations from the Electoral Commission. An incremental import only fetches
+    donations received since the last import's watermark; without a watermark, it falls
+    back to a full import. Donations reported late, with a received date before the
+    watermark, are only picked up by a full import. Given a snapshot ID, the snapshot's
+    archive is imported again instead.
+
+    Each batch is committed together with a checkpoint of the records read so far. If an
+    import is interrupted, the next download or file import resumes from its checkpoint
+    instead, whichever kind was asked for, until the checkpoint is abandoned. Importing
+    a snapshot again abandons it too.
+
+    Batches of a download which are identical to a batch of the last imported snapshot
+    are already in the database, so they're archived but not imported again. An
+    unchanged download therefore leaves the database untouched."""
     try:
         _set_task_progress(0)
-        if current_app.config["TESTING"]:
-            downloaded_data = "./tests/raw_data_2023-01-01.csv"
-        else:
-            # A fudge. Calling 2 methods from routes, one after another, was bad because it
-            # would require the route to know when download_raw_data was finished. Putting both
-            # download_raw_data and db_import in tasks was bad because there was no way to set a
-            # combined progress. Instead, we make 1 task and make up a rough progress
-            # percentage.
-            downloaded_data = download_raw_data()  # pragma: no cover
-        _set_task_progress(15)  # pragma: no cover
         add_missing_entries(DonationType)
         add_missing_entries(DonorType)
-
-        total_records = count_lines(downloaded_data)
-
-        with open(downloaded_data, newline="") as infile:
-            reader = csv.DictReader(infile)
-            for index, record in enumerate(reader):
-                import_record(record)
-                # Initially tried reporting progress every time, but this caused a
-                # 'prepared state' SQLAlchemy error
-                if index % 1000 == 0:
-                    # Fake percentage function
-                    _set_task_progress(round(((index / total_records * 85)) + 15))
-        cache.clear()
+        for model in [DonationType, DonorType, Recipient]:
+            totals.fill_slugs(model)
+        db.session.commit()
+        checkpoint = ImportCheckpoint.latest()
+        if snapshot_id is not None or not can_resume(checkpoint):
+            checkpoint = start_checkpoint(incremental, snapshot_id)
+        elif checkpoint.rows:
+            app.logger.info(
+                f"Resuming an interrupted import of {checkpoint.source} from record "
+                f"{checkpoint.rows}"
+            )
+        watermark = ImportWatermark.latest() if checkpoint.incremental else None
+        snapshot, resumed = checkpoint.snapshot, checkpoint.rows > 0
+        batch_size = current_app.config["IMPORT_BATCH_SIZE"]
+
+        # Progress is the share of the file, or of the download, read so far; records are
+        # imported as they download. A download resumes at the first uncommitted record,
+        # while a file is read again from the start, skipping the records already
+        # committed.
+        if archive.is_archive(checkpoint.source):
+            source = ProgressFile(checkpoint.source)
+            batches = skip_batches(archive.read_archive(source), checkpoint.rows)
+        elif checkpoint.source_hash:
+            source, infile = open_csv_file(checkpoint.source)
+            batches = csv_batches(infile, batch_size, checkpoint.rows)
+        else:
+            if resumed:
+                resume_snapshot(snapshot, checkpoint.rows)
+            source, infile = download_raw_data(checkpoint)
+            batches = csv_batches(infile, batch_size)
+        _set_task_progress(15)  # pragma: no cover
+        importer = BulkImporter(watermark=watermark)
+
+        # Only a download read from the start is archived. Batches of an incremental
+        # import may not have been imported in full.
+        previous = Snapshot.latest(full=True)
+        imported_batches = set(previous.get_batch_hashes()) if previous else set()
+        archive_file = None
+        if snapshot and not resumed:
+            archive_file = gzip.open(snapshot.archive_filename, "wb")
+        batch_hashes = []
+
+        for batch, rows in batches:
+            if archive_file:
+                line = archive.encode_batch(batch, rows)
+                archive_file.write(line)
+                batch_hash = hashlib.sha256(line).hexdigest()
+                batch_hashes.append(batch_hash)
+                if batch_hash not in imported_batches:
+                    importer.add_batch(batch)
+            else:
+                importer.add_batch(batch)
+            checkpoint.rows += rows
+            importer.flush()
+            _set_task_progress(round(source.progress() * 85) + 15)
+
+        unchanged = False
+        if archive_file:
+            archive_file.close()
+            snapshot.batch_hashes_json = json.dumps(batch_hashes)
+        if snapshot:
+            unchanged = finish_snapshot(snapshot, source, resumed, previous)
+        db.session.delete(checkpoint)
+        if not unchanged:
+            save_watermark()
+            search.sync()
+            DonationMonth.rebuild()
+            totals.rebuild()
+            DatasetState.bump(imported=True)
+        db.session.commit()
+        if not unchanged:
+            update_statistics()
+            cache.clear()
     except:  # pragma: no cover
+        db.session.rollback()
         app.logger.error(
             "Unhandled exception", exc_info=sys.exc_info()
         )  # pragma: no cover
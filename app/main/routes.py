@@ -1,12 +1,23 @@
-import csv
 import datetime as dt
 import dateutil.relativedelta as relativedelta
 import functools 
-import plotly.graph_objects as go
-import requests
+import gzip
+import hashlib
+import json
+import numpy as np
 import werkzeug
 
-from flask import flash, jsonify, redirect, request, render_template, send_file, url_for
+from flask import (
+    current_app,
+    flash,
+    jsonify,
+    make_response,
+    redirect,
+    request,
+    render_template,
+    session,
+    url_for,
+)
 from flask_login import current_user, login_required, login_user, logout_user
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
@@ -14,12 +25,17 @@ from wtforms.validators import (
     DataRequired,
 )
 
-from app import db
+from app import charts, db
+from app.db_import.normalise import slugify
 from app.models import (
     User,
+    AliasTotal,
+    DatasetState,
     DonorAlias,
     Donor,
+    DonorType,
     Donation,
+    DonationMonth,
     Notification,
     Recipient,
     DonationType,
@@ -44,6 +60,12 @@ OTHER_DONATION_TYPES = [
     "donation_type_impermissible_donor",
     "donation_type_unidentified_donor",
 ]
+OTHER_DONOR_TYPE_SLUGS = [
+    filter.replace("donor_type_", "") for filter in OTHER_DONOR_TYPES
+]
+OTHER_DONATION_TYPE_SLUGS = [
+    filter.replace("donation_type_", "") for filter in OTHER_DONATION_TYPES
+]
 DEFAULT_FILTERS = "filter=recipient_labour_party&filter=recipient_conservative_and_unionist_party&filter=recipient_liberal_democrats&filter=recipient_scottish_national_party_snp&filter=recipient_green_party&filter=recipient_reform_uk&filter=recipient_other&filter=is_legacy_true&filter=is_legacy_false&filter=donor_type_individual&filter=donor_type_company&filter=donor_type_limited_liability_partnership&filter=donor_type_trade_union&filter=donor_type_unincorporated_association&filter=donor_type_trust&filter=donor_type_friendly_society&filter=donation_type_cash&filter=donation_type_non_cash&filter=donation_type_visit&filter=donation_type_exempt_trust"
 
 DEFAULT_FILTERS_NO_RECIPIENTS = "&filter=is_legacy_true&filter=is_legacy_false&filter=donor_type_individual&filter=donor_type_company&filter=donor_type_limited_liability_partnership&filter=donor_type_trade_union&filter=donor_type_unincorporated_association&filter=donor_type_trust&filter=donor_type_friendly_society&filter=donation_type_cash&filter=donation_type_non_cash&filter=donation_type_visit&filter=donation_type_exempt_trust"
@@ -97,15 +119,64 @@ class LoginForm(FlaskForm):
 def check_donation_records(func):
     @functools.wraps(func)
     def decorated_function(*args, **kwargs):
-        if db.session.execute(db.select(Donation)).all() == []:
+        if not DatasetState.current().donations:
             return render_template("no_records.html", title="No records")
         return func(*args, **kwargs)
     return decorated_function
 
+def versioned(func):
+    """Gives responses a strong ETag and a Last-Modified date from the dataset version, so
+    that requests which already have the current version are answered with a 304 before
+    the view runs. Pages for logged-in users show their tasks, and flashed messages are
+    only shown once, so those responses are left alone. Responses are gzipped if the
+    client accepts it and COMPRESS_RESPONSES is set."""
+
+    @functools.wraps(func)
+    def decorated_function(*args, **kwargs):
+        if current_user.is_authenticated or session.get("_flashes"):
+            return func(*args, **kwargs)
+        state = DatasetState.current()
+        etag = json.dumps([state.version, request.full_path])
+        etag = hashlib.sha256(etag.encode("utf-8")).hexdigest()[:32]
+        gzipped = (
+            current_app.config["COMPRESS_RESPONSES"]
+            and request.accept_encodings["gzip"] > 0
+        )
+        # Gzipped responses are a different representation, so have their own ETag
+        variants = [etag, etag + "-gzip"]
+        if request.if_none_match:
+            fresh = any(request.if_none_match.contains_weak(tag) for tag in variants)
+        else:
+            fresh = bool(
+                state.updated
+                and request.if_modified_since
+                and state.updated.replace(microsecond=0, tzinfo=dt.timezone.utc)
+                <= request.if_modified_since
+            )
+
+        if fresh:
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            gzipped = gzipped and len(response.get_data()) > 1024
+            if gzipped:
+                response.set_data(gzip.compress(response.get_data()))
+                response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(variants[1] if gzipped else variants[0])
+        if state.updated:
+            response.last_modified = state.updated.replace(tzinfo=dt.timezone.utc)
+        response.vary.add("Accept-Encoding")
+        response.cache_control.no_cache = True
+        return response
+
+    return decorated_function
+
 def alias_check():
-    donor_number = len(db.session.execute(db.select(Donor)).scalars().all())
-    alias_number = len(db.session.execute(db.select(DonorAlias)).all())
-    return donor_number == alias_number
+    """Whether no donors have been given a shared alias"""
+    state = DatasetState.current()
+    return state.donors == state.aliases
 
             
 
@@ -134,21 +205,17 @@ def index():
     )
 
 
-def populate_filter_statements(filters, prefix, db_field):
-    output = []
-    for filter in filters:
-        filter = (
-            filter.replace(prefix, "")
-            .replace("_", " ")
-            .replace("(", "")
-            .replace(")", "")
-        )
-        filter = (
-            db.func.REPLACE(db.func.REPLACE(db.func.lower(db_field), "(", ""), ")", "")
-            == filter
-        )
-        output.append(filter)
-    return output
+def filter_slugs(filters, prefix):
+    """The slugs picked by those filters which start with prefix"""
+    return [filter[len(prefix):] for filter in filters if filter.startswith(prefix)]
+
+
+def slug_filter(slugs, model, column, exclude=False):
+    """Selects column from the rows of model with one of slugs, or from the other rows
+    if exclude is set. Slugs are indexed, so the lookup is a seek rather than a scan."""
+    return db.select(column).where(
+        model.slug.not_in(slugs) if exclude else model.slug.in_(slugs)
+    )
 
 
 def apply_date_filters(query, all_filters):
@@ -164,6 +231,43 @@ def apply_date_filters(query, all_filters):
     return query
 
 
+def donation_months(all_filters=()):
+    """DonationMonth, with any date filters applied. Months wholly between the dates are
+    read from the table, and the months the dates fall in are summed from the donations
+    in range, so the result has the table's columns either way."""
+    dates = {"date_gt_": [], "date_lt_": []}
+    for filter in all_filters:
+        if filter[:8] in dates:
+            dates[filter[:8]].append(dt.datetime.strptime(filter[-10:], "%Y-%m-%d"))
+    if not dates["date_gt_"] and not dates["date_lt_"]:
+        return DonationMonth.__table__
+    whole_months = db.select(
+        *[column for column in DonationMonth.__table__.c if column.name != "id"]
+    )
+    edges = []
+    if dates["date_gt_"]:
+        start = max(dates["date_gt_"]).date().replace(day=1)
+        whole_months = whole_months.where(DonationMonth.month > start)
+        edges.append(start)
+    if dates["date_lt_"]:
+        end = min(dates["date_lt_"]).date().replace(day=1)
+        whole_months = whole_months.where(DonationMonth.month < end)
+        edges.append(end)
+    part_months = DonationMonth.summarise(
+        db.or_(
+            *[
+                db.and_(
+                    Donation.date >= month,
+                    Donation.date < month + relativedelta.relativedelta(months=1),
+                )
+                for month in edges
+            ]
+        )
+    )
+    part_months = apply_date_filters(part_months, all_filters)
+    return db.union_all(whole_months, part_months).subquery()
+
+
 def assign_colours_to_donor_types(query, index):
     """Takes a query and the donor type's relevant index. Assigns each record in that
     query according to the DONOR_TYPE_COLOURS variable. Returns a list of the donor type
@@ -212,33 +316,78 @@ def recipient(id):
             )
         )
 
+    # Only the date filters change the charts
     all_filters = request.args.getlist("filter")
-    donation_type_filter_statements = populate_filter_statements(
-        OTHER_DONATION_TYPES, "donation_type_", DonationType.name
+    date_filters = sorted(
+        filter for filter in all_filters if filter.startswith(("date_gt_", "date_lt_"))
     )
-    donor_type_filter_statements = populate_filter_statements(
-        OTHER_DONOR_TYPES, "donor_type_", Donor.donor_type_id
+    top_donor_graph, donation_sources_graph = recipient_charts(id, date_filters)
+
+    # Prepare filter_list for link to full donations list
+    filter_list = "?filter=recipient_"
+    filter_list += recipient.slug or slugify(recipient.name)
+    filter_list += DEFAULT_FILTERS_NO_RECIPIENTS
+
+    if alias_check() and current_user.is_authenticated: # pragma no cover
+        flash("""
+Set up aliases (see navigation bar above), otherwise the figures on this page will be misleading
+        """)
+    elif alias_check(): # pragma no cover
+        flash("""
+An administrator needs to set up aliases, otherwise the figures on this page will be misleading
+        """)
+
+    return render_template(
+        "recipient.html",
+        title=title,
+        recipient=recipient,
+        top_donor_graph=top_donor_graph,
+        donation_sources_graph=donation_sources_graph,
+        form=form,
+        filter_list=filter_list,
     )
 
-    top_donor_query = (
-        db.session.query(
-            DonorAlias.name,
-            Donor.donor_type_id,
-            db.func.sum(Donation.value).label("donations"),
-            db.func.min(Donation.date).label("first_gift"),
-            db.func.max(Donation.date).label("latest_gift"),
-        )
-        .join(Donor.donor_alias)
-        .join(Donation)
-        .join(Recipient)
-        .join(DonationType)
-        .where(Recipient.name == recipient.name)
-        .where(db.not_(db.or_(*donation_type_filter_statements)))
-        .where(db.not_(db.or_(*donor_type_filter_statements)))
-        .group_by(DonorAlias.name)
-        .order_by(db.desc("donations"))
+
+@charts.cached
+def recipient_charts(id, date_filters):
+    """The recipient page's top donor and donation source charts, as JSON"""
+    other_donation_types = slug_filter(
+        OTHER_DONATION_TYPE_SLUGS, DonationType, DonationType.id
     )
-    top_donor_query = apply_date_filters(top_donor_query, all_filters)
+    other_donor_types = slug_filter(OTHER_DONOR_TYPE_SLUGS, DonorType, DonorType.name)
+
+    if date_filters:
+        top_donor_query = (
+            db.session.query(
+                DonorAlias.name,
+                Donor.donor_type_id,
+                db.func.sum(Donation.value).label("donations"),
+                db.func.min(Donation.date).label("first_gift"),
+                db.func.max(Donation.date).label("latest_gift"),
+            )
+            .join(Donor.donor_alias)
+            .join(Donation)
+            .where(Donation.recipient_id == id)
+            .where(Donation.donation_type_id.not_in(other_donation_types))
+            .where(Donor.donor_type_id.not_in(other_donor_types))
+            .group_by(DonorAlias.name)
+            .order_by(db.desc("donations"))
+        )
+        top_donor_query = apply_date_filters(top_donor_query, date_filters)
+    else:
+        # Without dates, the leaderboard is kept up to date in AliasTotal
+        top_donor_query = (
+            db.session.query(
+                DonorAlias.name,
+                AliasTotal.donor_type_id,
+                AliasTotal.total.label("donations"),
+                AliasTotal.first_gift,
+                AliasTotal.latest_gift,
+            )
+            .join(DonorAlias, DonorAlias.id == AliasTotal.donor_alias_id)
+            .where(AliasTotal.recipient_id == id)
+            .order_by(AliasTotal.total.desc())
+        )
     top_donor_query = top_donor_query.limit(100).all()
 
     top_donors = [record[0] for record in top_donor_query]
@@ -247,66 +396,57 @@ def recipient(id):
     first_gift = [record[3] for record in top_donor_query]
     latest_gift = [record[4] for record in top_donor_query]
 
-    top_donor_graph = go.Figure(
-        data=[
-            go.Bar(
+    top_donor_graph = charts.figure(
+        [
+            charts.trace(
+                "bar",
                 x=top_donors,
                 y=donations,
                 customdata=list(zip(first_gift, latest_gift)),
                 hovertemplate="£%{y:.4s}"
                 "<extra>First Gift: %{customdata[0]}<br>Latest Gift: %{customdata[1]}</extra>",
-                marker_color=donor_type,
-                marker_line={"width": 0},
+                marker={"color": donor_type, "line": {"width": 0}},
                 showlegend=False,
             ),
         ],
-        layout={
-            "title": "Top Donors",
-            "xaxis": {"title": "", "range": [-0.5, 10.5]},
-            "yaxis": {"title": "£", "type": "linear"},
-            "legend": {
-                "x": 0,
-                "y": 1.02,
-                "bgcolor": "rgba(255,255,255,0)",
-                "bordercolor": "rgba(255,255,255,0)",
-                "orientation": "h",
-                "yanchor": "bottom",
-            },
-            "hovermode": "closest",
-            "font_family": "'Helvetica Neue', 'Open Sans', Arial",
-            "font_color": "rgba(255,255,255,255)",
-            "paper_bgcolor": "rgba(0,0,0,0)",
-            "plot_bgcolor": "rgba(0,0,0,0)",
+        title={"text": "Top Donors"},
+        xaxis={"range": [-0.5, 10.5], "title": {"text": ""}},
+        yaxis={"title": {"text": "£"}, "type": "linear"},
+        legend={
+            "bgcolor": "rgba(255,255,255,0)",
+            "bordercolor": "rgba(255,255,255,0)",
+            "orientation": "h",
+            "x": 0,
+            "y": 1.02,
+            "yanchor": "bottom",
         },
+        hovermode="closest",
+        font=charts.FONT,
+        paper_bgcolor="rgba(0,0,0,0)",
+        plot_bgcolor="rgba(0,0,0,0)",
     )
 
     for donor_type, colour in relevant_types.items():
-        top_donor_graph.add_trace(
-            go.Scatter(
+        top_donor_graph["data"].append(
+            charts.trace(
+                "scatter",
                 x=[None],
                 y=[None],
                 name=donor_type,
-                marker_color=colour,
                 line={"color": "rgba(0,0,0,0.0)"},
-                marker={"size": 80},
+                marker={"color": colour, "size": 80},
             ),
         )
 
-    donation_sources_query = (
-        db.session.query(
-            Donor.donor_type_id, db.func.sum(Donation.value).label("donations")
-        )
-        .join(Donation)
-        .join(DonationType)
-        .join(Recipient)
-        .filter(Recipient.name == recipient.name)
-        .filter(db.not_(db.or_(*donation_type_filter_statements)))
-        .filter(db.not_(db.or_(*donor_type_filter_statements)))
-        .group_by(Donor.donor_type_id)
+    months = donation_months(date_filters)
+    donation_sources_query = db.session.execute(
+        db.select(months.c.donor_type_id, db.func.sum(months.c.total).label("donations"))
+        .where(months.c.recipient_id == id)
+        .where(months.c.donation_type_id.not_in(other_donation_types))
+        .where(months.c.donor_type_id.not_in(other_donor_types))
+        .group_by(months.c.donor_type_id)
         .order_by(db.desc("donations"))
-    )
-    donation_sources_query = apply_date_filters(donation_sources_query, all_filters)
-    donation_sources_query = donation_sources_query.all()
+    ).all()
 
     sources = [record[0] for record in donation_sources_query]
     donations_by_source = [record[1] for record in donation_sources_query]
@@ -314,60 +454,31 @@ def recipient(id):
         donation_sources_query, 0
     )
 
-    donation_sources_graph = go.Figure(
-        data=[
-            go.Bar(
+    donation_sources_graph = charts.figure(
+        [
+            charts.trace(
+                "bar",
                 x=donations_by_source,
                 y=sources,
                 showlegend=False,
                 hovertemplate="£%{x:.4s}<extra></extra>",
                 orientation="h",
-                marker_color=donor_type,
-                marker_line={"width": 0},
+                marker={"color": donor_type, "line": {"width": 0}},
             ),
         ],
-        layout={
-            "title": "Source of funds",
-            "yaxis": {
-                "title": "",
-            },
-            "xaxis": {
-                "title": "£",
-                "type": "linear",
-            },
-            "font_family": "'Helvetica Neue', 'Open Sans', Arial",
-            "font_color": "rgba(255,255,255,255)",
-            "paper_bgcolor": "rgba(0,0,0,0)",
-            "plot_bgcolor": "rgba(0,0,0,0)",
+        title={"text": "Source of funds"},
+        yaxis={
+            "constrain": "domain",
+            "range": [-0.5, 2.5],
+            "ticksuffix": " ",
+            "title": {"text": ""},
         },
+        xaxis={"title": {"text": "£"}, "type": "linear"},
+        font=charts.FONT,
+        paper_bgcolor="rgba(0,0,0,0)",
+        plot_bgcolor="rgba(0,0,0,0)",
     )
-    donation_sources_graph.update_yaxes(
-        range=(-0.5, 2.5), constrain="domain", ticksuffix=" "
-    )
-
-    # Prepare filter_list for link to full donations list
-    filter_list = "?filter=recipient_"
-    filter_list += recipient.name.lower().replace(" ", "_")
-    filter_list += DEFAULT_FILTERS_NO_RECIPIENTS
-
-    if alias_check() and current_user.is_authenticated: # pragma no cover
-        flash("""
-Set up aliases (see navigation bar above), otherwise the figures on this page will be misleading
-        """)
-    elif alias_check(): # pragma no cover
-        flash("""
-An administrator needs to set up aliases, otherwise the figures on this page will be misleading
-        """)
-
-    return render_template(
-        "recipient.html",
-        title=title,
-        recipient=recipient,
-        top_donor_graph=top_donor_graph.to_json(),
-        donation_sources_graph=donation_sources_graph.to_json(),
-        form=form,
-        filter_list=filter_list,
-    )
+    return charts.to_json(top_donor_graph), charts.to_json(donation_sources_graph)
 
 
 def assign_colours_to_parties(party):
@@ -397,7 +508,20 @@ def donor(id):
             )
         )
 
-    # Total giving over time bar graph
+    gifts_graph = gifts_chart(alias.name)
+
+    return render_template(
+        "donor.html",
+        title=title,
+        alias=alias,
+        form=form,
+        gifts_graph=gifts_graph,
+    )
+
+
+@charts.cached
+def gifts_chart(alias_name):
+    """The donor page's chart of giving to each recipient by year, as JSON"""
     gifts_query = (
         db.session.query(
             Recipient.name,
@@ -407,146 +531,113 @@ def donor(id):
         .join(Donor.donations)
         .join(Recipient)
         .join(DonorAlias)
-        .where(DonorAlias.name == alias.name)
+        .where(DonorAlias.name == alias_name)
         .order_by(Donation.date)
         .group_by("year", Recipient.name)
     ).all()
 
     bar_names = list(set([record[0] for record in gifts_query]))
-    dates = [record[1] for record in gifts_query]
-    start_year, end_year, date_series = int(dates[0]), int(dates[-1]), []
-    while start_year <= end_year:
-        date_series.append(start_year)
-        start_year += 1
-
-    parties = {}
-    for key in bar_names:
-        parties[key] = [0] * len(date_series)
-    for record in gifts_query:
-        date = int(record[1])
-        index = date_series.index(date)
-        parties = update_party_sums(parties, index, record[0], record[2])
+    names, years, values = zip(*gifts_query)
+    years = np.array(years, dtype=int)
+    date_series = list(range(years.min(), years.max() + 1))
+    totals = pivot(names, years - years.min(), values, bar_names, len(date_series))
+    parties = dict(zip(bar_names, totals.tolist()))
 
     bars = []
     for i in bar_names:
         party_colour = assign_colours_to_parties(i)
         bars.append(
-            go.Bar(
+            charts.trace(
+                "bar",
                 name=i,
                 x=date_series,
                 y=parties[i],
                 hovertemplate="£%{y:.4s}",
-                marker_color=party_colour,
-                marker_line={"width": 0},
+                marker={"color": party_colour, "line": {"width": 0}},
             )
         )
 
-    # Assign colours
-    gifts_graph = go.Figure(
-        data=bars,
-        layout={
-            "xaxis": {
-                "title": "",
-                "dtick": 1,
-            },
-            "yaxis": {
-                "title": "£",
-                "type": "linear",
-            },
-            "font_family": "'Helvetica Neue', 'Open Sans', Arial",
-            "font_color": "rgba(255,255,255,255)",
-            "paper_bgcolor": "rgba(0,0,0,0)",
-            "plot_bgcolor": "rgba(0,0,0,0)",
-        },
+    gifts_graph = charts.figure(
+        bars,
+        xaxis={"dtick": 1, "title": {"text": ""}},
+        yaxis={"title": {"text": "£"}, "type": "linear"},
+        font=charts.FONT,
+        paper_bgcolor="rgba(0,0,0,0)",
+        plot_bgcolor="rgba(0,0,0,0)",
     )
-
-    return render_template(
-        "donor.html",
-        title=title,
-        alias=alias,
-        form=form,
-        gifts_graph=gifts_graph.to_json(),
+    return charts.to_json(gifts_graph)
+
+
+def pivot(row_keys, column_offsets, values, row_names, column_count):
+    """Sums values into a NumPy matrix with a row for each of row_names and column_count
+    columns, adding each value to the row named by its key and the column at its offset.
+    Values whose key isn't in row_names are added to the last row."""
+    rows = {name: index for index, name in enumerate(row_names)}
+    row_offsets = np.fromiter(
+        (rows.get(key, len(row_names) - 1) for key in row_keys),
+        dtype=np.intp,
+        count=len(row_keys),
     )
+    matrix = np.zeros((len(row_names), column_count))
+    np.add.at(matrix, (row_offsets, np.asarray(column_offsets, dtype=np.intp)), values)
+    return matrix
 
 
-def update_party_sums(parties, index, party_name, value):
-    if party_name in parties.keys():
-        parties[party_name][index] = value
-        return parties
-    parties["All other parties"][index] += value
-    return parties
+def month_offsets(dates, start_date):
+    """The number of months from start_date's month to each of dates' months"""
+    months = np.array(dates, dtype="datetime64[M]")
+    return (months - np.datetime64(start_date, "M")).astype(int)
 
 
 def convert_to_js_array(query):
-    """Accepts a query in the form of a list of lists. Applies escaping to the first
-    column. If it's not a float, it'll wrap it in ". Returns a JS-formatted array."""
-    output = ""
-    for record in query:
-        row = "["
-        for index, cell in enumerate(record):
-            if index == 0:
-                cell = cell.replace('"', '\\"')
-            try:
-                float(cell)
-            except:
-                cell = '"' + str(cell) + '"'
-            row += str(cell)
-            if index != len(record) - 1:
-                row += ", "
-        row += "], "
-        output += row
-    output = output.rstrip(", ")
-    return output
+    """Accepts a query in the form of a list of lists. Returns its rows as JS arrays,
+    separated by commas, with strings escaped and dates formatted as strings."""
+    return ", ".join(
+        json.dumps(list(record), ensure_ascii=False, default=str) for record in query
+    )
 
 
 def generate_date_series(start_date, end_date):
-    date_series = []
-    while start_date < end_date:
-        date_series.append(start_date)
-        start_date += relativedelta.relativedelta(months=1)
-    return date_series
+    """The first day of each month from start_date's month to end_date's"""
+    months = np.arange(
+        np.datetime64(start_date, "M"), np.datetime64(end_date, "M") + 1
+    )
+    return months.astype("datetime64[D]").tolist()
 
-@bp.route("/recipients")
-@check_donation_records
-def recipients():
+
+@charts.cached
+def recipients_content():
+    """The recipients page's chart, as JSON, and its table of recipients"""
     # Generate dates
-    start_date = db.session.query(db.func.min(Donation.date)).first()[0].replace(day=1)
-    end_date = db.session.query(db.func.max(Donation.date)).first()[0]
+    state = DatasetState.current()
+    start_date = state.first_donation.replace(day=1)
+    end_date = state.last_donation
     date_series = generate_date_series(start_date, end_date)
 
-    donation_type_filter_statements = populate_filter_statements(
-        OTHER_DONATION_TYPES, "donation_type_", DonationType.name
-    )
-    donor_type_filter_statements = populate_filter_statements(
-        OTHER_DONOR_TYPES, "donor_type_", Donor.donor_type_id
+    other_donation_types = slug_filter(
+        OTHER_DONATION_TYPE_SLUGS, DonationType, DonationType.id
     )
+    other_donor_types = slug_filter(OTHER_DONOR_TYPE_SLUGS, DonorType, DonorType.name)
+
+    # Monthly is the smallest useful aggregation, so it's kept in DonationMonth, with
+    # extra binning done by Plotly
+    months = donation_months()
+    party = db.case(
+        (Recipient.name.in_(MAIN_PARTIES), Recipient.name), else_="All other parties"
+    ).label("party")
+    party_stats_query = db.session.execute(
+        db.select(party, months.c.month, db.func.sum(months.c.total))
+        .join(Recipient, Recipient.id == months.c.recipient_id)
+        .where(months.c.donation_type_id.not_in(other_donation_types))
+        .where(months.c.donor_type_id.not_in(other_donor_types))
+        .group_by(months.c.month, party)
+    ).all()
 
-    # Monthly is the smallest useful aggregation, so it's most efficient to do (and cache)
-    # that aggregation on the server, with extra binning done by Plotly
-    party_stats_query = (
-        db.session.query(
-            Recipient.name,
-            db.func.strftime("%Y-%m", Donation.date).label("month"),
-            db.func.sum(Donation.value),
-            Recipient.id,
-        )
-        .join(Recipient)
-        .join(Donor)
-        .join(DonationType)
-        .where(db.not_(db.or_(*donation_type_filter_statements)))
-        .where(db.not_(db.or_(*donor_type_filter_statements)))
-        .group_by("month", Recipient.name)
-        .all()
+    names, dates, values = zip(*party_stats_query) if party_stats_query else ([],) * 3
+    totals = pivot(
+        names, month_offsets(dates, start_date), values, MAIN_PARTIES, len(date_series)
     )
-
-    parties = {}
-    for key in MAIN_PARTIES:
-        parties[key] = [0] * len(date_series)
-
-    for record in party_stats_query:
-        date = dt.datetime.strptime(record[1], "%Y-%m").date()
-        index = date_series.index(date)
-        parties = update_party_sums(parties, index, record[0], round(record[2], 2))
+    parties = dict(zip(MAIN_PARTIES, totals.round(2).tolist()))
 
     yview_args = [
         {"xbins.size": "M12"},
@@ -590,154 +681,152 @@ def recipients():
         },
     ]
 
-    figure = go.Figure(
-        data=[
-            go.Histogram(
+    figure = charts.figure(
+        [
+            charts.trace(
+                "histogram",
                 name="Conservative Party",
                 customdata=["Conservative Party"] * len(date_series),
                 x=date_series,
                 y=parties["Conservative and Unionist Party"],
-                xbins={"start": dt.datetime(2001, 1, 1), "size": "M12"},
-                marker_color="rgb(0, 135, 220)",
+                xbins={"size": "M12", "start": dt.datetime(2001, 1, 1)},
+                marker={"color": "rgb(0, 135, 220)"},
                 histfunc="sum",
                 hovertemplate="£%{y:.4s}<extra>%{customdata}</extra>",
             ),
-            go.Histogram(
+            charts.trace(
+                "histogram",
                 name="Labour Party",
                 customdata=["Labour Party"] * len(date_series),
                 x=date_series,
                 y=parties["Labour Party"],
-                xbins={"start": dt.datetime(2001, 1, 1), "size": "M12"},
-                marker_color="rgb(228, 0, 59)",
+                xbins={"size": "M12", "start": dt.datetime(2001, 1, 1)},
+                marker={"color": "rgb(228, 0, 59)"},
                 histfunc="sum",
                 hovertemplate="£%{y:.4s}<extra>%{customdata}</extra>",
             ),
-            go.Histogram(
+            charts.trace(
+                "histogram",
                 name="Liberal Democrats",
                 customdata=["Liberal Democrats"] * len(date_series),
                 x=date_series,
                 y=parties["Liberal Democrats"],
-                xbins={"start": dt.datetime(2001, 1, 1), "size": "M12"},
-                marker_color="rgb(255, 159, 26)",
+                xbins={"size": "M12", "start": dt.datetime(2001, 1, 1)},
+                marker={"color": "rgb(255, 159, 26)"},
                 histfunc="sum",
                 hovertemplate="£%{y:.4s}<extra>%{customdata}</extra>",
                 visible="legendonly",
             ),
-            go.Histogram(
+            charts.trace(
+                "histogram",
                 name="Reform UK (formerly Brexit Party)",
                 customdata=["Reform UK"] * len(date_series),
                 x=date_series,
                 y=parties["Reform UK"],
-                xbins={"start": dt.datetime(2001, 1, 1), "size": "M12"},
-                marker_color="rgb(0, 146, 180)",
+                xbins={"size": "M12", "start": dt.datetime(2001, 1, 1)},
+                marker={"color": "rgb(0, 146, 180)"},
                 histfunc="sum",
                 hovertemplate="£%{y:.4s}<extra>%{customdata}</extra>",
                 visible="legendonly",
             ),
-            go.Histogram(
+            charts.trace(
+                "histogram",
                 name="All other parties",
                 customdata=["All other parties"] * len(date_series),
                 x=date_series,
                 y=parties["All other parties"],
-                xbins={"start": dt.datetime(2001, 1, 1), "size": "M12"},
-                marker_color="rgb(62, 143, 0)",
+                xbins={"size": "M12", "start": dt.datetime(2001, 1, 1)},
+                marker={"color": "rgb(62, 143, 0)"},
                 histfunc="sum",
                 hovertemplate="£%{y:.4s}<extra>%{customdata}</extra>",
                 visible="legendonly",
             ),
         ],
-        layout={
-            "title": "Reportable Donations to Political Parties",
-            "xaxis": {"title": "", "type": "date"},
-            "xaxis_hoverformat": "%b %Y",
-            "yaxis": {"title": "£", "type": "linear"},
-            "sliders": [
-                {
-                    "active": 0,
-                    "pad": {"t": 50},
-                    "steps": [
-                        {"args": yview_args, "label": "Year", "method": "update"},
-                        {"args": qview_args, "label": "Quarter", "method": "update"},
-                        {"args": mview_args, "label": "Month", "method": "update"},
-                    ],
-                }
-            ],
-            "legend": {
-                "x": 0.01,
-                "y": 1.01,
-                "bgcolor": "rgba(0,0,0,0)",
-                "bordercolor": "rgba(0,0,0,0)",
-            },
-            "hovermode": "x",
-            "font_family": "'Helvetica Neue', 'Open Sans', Arial",
-            "font_color": "rgba(255,255,255,255)",
-            "paper_bgcolor": "rgba(0,0,0,0)",
-            "plot_bgcolor": "rgba(0,0,0,0)",
+        title={"text": "Reportable Donations to Political Parties"},
+        xaxis={
+            "dtick": "M12",
+            "hoverformat": "%b %Y",
+            "tick0": dt.datetime(2001, 7, 2),
+            "tickformat": "%Y",
+            "title": {"text": ""},
+            "type": "date",
         },
+        yaxis={
+            "tickangle": 90,
+            "tickformat": ".2s",
+            "ticklabelstep": 1,
+            "title": {"text": "£"},
+            "type": "linear",
+        },
+        sliders=[
+            {
+                "active": 0,
+                "pad": {"t": 50},
+                "steps": [
+                    {"args": yview_args, "label": "Year", "method": "update"},
+                    {"args": qview_args, "label": "Quarter", "method": "update"},
+                    {"args": mview_args, "label": "Month", "method": "update"},
+                ],
+            }
+        ],
+        legend={
+            "bgcolor": "rgba(0,0,0,0)",
+            "bordercolor": "rgba(0,0,0,0)",
+            "x": 0.01,
+            "y": 1.01,
+        },
+        hovermode="x",
+        font=charts.FONT,
+        paper_bgcolor="rgba(0,0,0,0)",
+        plot_bgcolor="rgba(0,0,0,0)",
     )
-    figure.update_xaxes(
-        tick0=dt.datetime(2001, 7, 2),
-        dtick="M12",
-        tickformat="%Y",
-    )
-    figure.update_yaxes(
-        tickangle=90,
-        ticklabelstep=1,
-        tickformat=".2s",
-    )
-    figure.update_traces()
 
-    recipient_query = (
-        db.session.query(
+    recipient_query = db.session.execute(
+        db.select(
             Recipient.name,
             Recipient.id,
-            db.func.sum(Donation.value).label("donations"),
+            db.func.sum(months.c.total).label("donations"),
         )
-        .join(Donation)
-        .join(Donor)
-        .join(DonationType)
-        .where(db.not_(db.or_(*donation_type_filter_statements)))
-        .where(db.not_(db.or_(*donor_type_filter_statements)))
+        .join(Recipient, Recipient.id == months.c.recipient_id)
+        .where(months.c.donation_type_id.not_in(other_donation_types))
+        .where(months.c.donor_type_id.not_in(other_donor_types))
         .group_by(Recipient.name)
         .order_by(db.desc("donations"))
     ).all()
     recipients = convert_to_js_array(recipient_query)
+    return charts.to_json(figure), recipients
+
+
+@bp.route("/recipients")
+@versioned
+@check_donation_records
+def recipients():
+    figure, recipients = recipients_content()
 
     # Response
     return render_template(
         "recipients.html",
         title="Recipients",
-        figure=figure.to_json(),
+        figure=figure,
         recipients=recipients,
     )
 
 
-@bp.route("/donors")
-@check_donation_records
-def donors():
-    donation_type_filter_statements = populate_filter_statements(
-        OTHER_DONATION_TYPES, "donation_type_", DonationType.name
-    )
-    donor_type_filter_statements = populate_filter_statements(
-        OTHER_DONOR_TYPES, "donor_type_", Donor.donor_type_id
-    )
-
-    top_donor_query = (
-        db.session.query(
+@charts.cached
+def donors_content():
+    """The donors page's chart, as JSON, and its table of donors"""
+    top_donor_query = db.session.execute(
+        db.select(
             DonorAlias.name,
             DonorAlias.id,
-            Donor.donor_type_id,
-            db.func.sum(Donation.value).label("donations"),
-            db.func.min(Donation.date).label("first_gift"),
-            db.func.max(Donation.date).label("latest_gift"),
+            AliasTotal.donor_type_id,
+            AliasTotal.total.label("donations"),
+            AliasTotal.first_gift,
+            AliasTotal.latest_gift,
         )
-        .join(Donor, DonorAlias.id == Donor.donor_alias_id)
-        .join(Donation)
-        .join(DonationType)
-        .where(db.not_(db.or_(*donation_type_filter_statements)))
-        .where(db.not_(db.or_(*donor_type_filter_statements)))
-        .group_by(DonorAlias.name)
-        .order_by(db.desc("donations"))
+        .join(DonorAlias, DonorAlias.id == AliasTotal.donor_alias_id)
+        .where(AliasTotal.recipient_id == None)
+        .order_by(AliasTotal.total.desc())
     ).all()
     top_donors = convert_to_js_array(top_donor_query)
 
@@ -747,50 +836,55 @@ def donors():
     first_gift = [record[4] for record in top_donor_query]
     latest_gift = [record[5] for record in top_donor_query]
 
-    top_donor_graph = go.Figure(
-        data=[
-            go.Bar(
+    top_donor_graph = charts.figure(
+        [
+            charts.trace(
+                "bar",
                 x=top_donor_bars,
                 y=donations,
                 customdata=list(zip(first_gift, latest_gift)),
                 hovertemplate="£%{y:.4s}"
                 "<extra>First Gift: %{customdata[0]}<br>Latest Gift: %{customdata[1]}</extra>",
-                marker_color=donor_type,
-                marker_line={"width": 0},
+                marker={"color": donor_type, "line": {"width": 0}},
                 showlegend=False,
             ),
         ],
-        layout={
-            "title": "Biggest political donors (to all parties)",
-            "xaxis": {"title": "", "range": [-0.5, 10.5]},
-            "yaxis": {"title": "£", "type": "linear"},
-            "legend": {
-                "x": 0,
-                "y": 1.02,
-                "bgcolor": "rgba(255,255,255,0)",
-                "bordercolor": "rgba(255,255,255,0)",
-                "orientation": "h",
-                "yanchor": "bottom",
-            },
-            "hovermode": "closest",
-            "font_family": "'Helvetica Neue', 'Open Sans', Arial",
-            "font_color": "rgba(255,255,255,255)",
-            "paper_bgcolor": "rgba(0,0,0,0)",
-            "plot_bgcolor": "rgba(0,0,0,0)",
+        title={"text": "Biggest political donors (to all parties)"},
+        xaxis={"range": [-0.5, 10.5], "title": {"text": ""}},
+        yaxis={"title": {"text": "£"}, "type": "linear"},
+        legend={
+            "bgcolor": "rgba(255,255,255,0)",
+            "bordercolor": "rgba(255,255,255,0)",
+            "orientation": "h",
+            "x": 0,
+            "y": 1.02,
+            "yanchor": "bottom",
         },
+        hovermode="closest",
+        font=charts.FONT,
+        paper_bgcolor="rgba(0,0,0,0)",
+        plot_bgcolor="rgba(0,0,0,0)",
     )
 
     for donor_type, colour in relevant_types.items():
-        top_donor_graph.add_trace(
-            go.Scatter(
+        top_donor_graph["data"].append(
+            charts.trace(
+                "scatter",
                 x=[None],
                 y=[None],
                 name=donor_type,
-                marker_color=colour,
                 line={"color": "rgba(0,0,0,0)"},
-                marker={"size": 80},
+                marker={"color": colour, "size": 80},
             ),
         )
+    return charts.to_json(top_donor_graph), top_donors
+
+
+@bp.route("/donors")
+@versioned
+@check_donation_records
+def donors():
+    top_donor_graph, top_donors = donors_content()
 
     if alias_check() and current_user.is_authenticated:
         flash("""
@@ -804,7 +898,7 @@ An administrator needs to set up aliases, otherwise the figures on this page wil
     return render_template(
         "donors.html",
         title="Donors",
-        top_donor_graph=top_donor_graph.to_json(),
+        top_donor_graph=top_donor_graph,
         top_donors=top_donors,
     )
 
@@ -908,32 +1002,10 @@ def delete_user(id):
 
 
 @bp.route("/export", methods=["GET"])
-def export_data():  # pragma: no cover
-    """Export all donations: query API, convert to JSON and send_file it"""
+def export_data():
+    """Export all donations matching the filters, which the API streams as a CSV"""
     filter_string = request.query_string.decode() or DEFAULT_FILTERS
-    api_url = (
-        "http://"
-        + request.headers.get("Host", "localhost")
-        + url_for("api.data")
-        + "?"
-        + filter_string
-    )
-    print(api_url)
-    data = requests.get(api_url).json()["data"]
-    for record in data:
-        record["date"] = dt.datetime.strptime(
-            record["date"], "%a, %d %b %Y %H:%M:%S %Z"
-        )
-        record["date"] = record["date"].strftime("%Y-%m-%d")
-    filename = (
-        "donation_whistle_export_" + dt.datetime.now().strftime("%Y-%m-%d") + ".csv"
-    )
-    with open("app/" + filename, "w") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=PRETTY_FIELD_NAMES.keys())
-        writer.writerow(dict(PRETTY_FIELD_NAMES))
-        for record in data:
-            writer.writerow(record)
-    return send_file(filename, as_attachment=True, mimetype="csv")
+    return redirect(url_for("api.export") + "?" + filter_string)
 
 
 @bp.route("/notifications")
@@ -1,12 +1,13 @@
 import datetime as dt
 import json
+import os
 import redis
 import rq
 import time
 from typing import List
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from flask import current_app
+from flask import current_app, g, has_app_context
 from flask_login import UserMixin
 
 from app import db, login
@@ -19,6 +20,8 @@ class DonorType(db.Model):
     # Not bidirectional - I don't need to see all the donors from the type record
     donors: db.Mapped[List["Donor"]] = db.relationship()
     name = db.mapped_column(db.String(25))
+    # The name as it appears in filters, e.g. donor_type_trade_union
+    slug = db.mapped_column(db.String(25), index=True)
     display_name = db.mapped_column(db.String(25))
 
 
@@ -39,14 +42,18 @@ class Donor(db.Model):
     __tablename__ = "donor"
 
     id = db.mapped_column(db.Integer, primary_key=True)
-    donor_alias_id: db.Mapped[int] = db.mapped_column(db.ForeignKey("donor_alias.id"))
+    donor_alias_id: db.Mapped[int] = db.mapped_column(
+        db.ForeignKey("donor_alias.id"), index=True
+    )
     donor_alias: db.Mapped[List["DonorAlias"]] = db.relationship(
         back_populates="donors"
     )
-    donor_type_id: db.Mapped[int] = db.mapped_column(db.ForeignKey("donor_type.id"))
+    donor_type_id: db.Mapped[int] = db.mapped_column(
+        db.ForeignKey("donor_type.id"), index=True
+    )
     donor_type: db.Mapped["DonorType"] = db.relationship(back_populates="donors")
     donations: db.Mapped[List["Donation"]] = db.relationship(back_populates="donor")
-    name = db.mapped_column(db.String(100), index=True)
+    name = db.mapped_column(db.String(100), index=True, unique=True)
     ec_donor_id = db.mapped_column(db.Integer)
     # Would need to add an accounting unit ID to add non-central donations
     ec_regulated_entity_id = db.mapped_column(db.Integer)
@@ -61,7 +68,11 @@ class Recipient(db.Model):
     __tablename__ = "recipient"
 
     id = db.mapped_column(db.Integer, primary_key=True)
-    name = db.mapped_column(db.String(100), index=True)
+    name = db.mapped_column(db.String(100), index=True, unique=True)
+    # The name as it appears in filters, e.g. recipient_labour_party
+    slug = db.mapped_column(db.String(100), index=True)
+    # Main parties have their own filters, and the rest are filtered as "other"
+    is_main_party = db.mapped_column(db.Boolean, index=True)
     deregistered = db.mapped_column(db.Date)
     donations: db.Mapped[List["Donation"]] = db.relationship(back_populates="recipient")
 
@@ -74,6 +85,8 @@ class DonationType(db.Model):
 
     id = db.mapped_column(db.Integer, primary_key=True)
     name = db.mapped_column(db.String(100), index=True)
+    # The name as it appears in filters, e.g. donation_type_non_cash
+    slug = db.mapped_column(db.String(100), index=True)
     donations: db.Mapped[List["Donation"]] = db.relationship(
         back_populates="donation_type"
     )
@@ -86,21 +99,26 @@ class Donation(db.Model):
     __tablename__ = "donation"
 
     id = db.mapped_column(db.Integer, primary_key=True)
-    donor_id: db.Mapped[int] = db.mapped_column(db.ForeignKey("donor.id"))
+    donor_id: db.Mapped[int] = db.mapped_column(db.ForeignKey("donor.id"), index=True)
     donor: db.Mapped["Donor"] = db.relationship(back_populates="donations")
     recipient_id: db.Mapped[int] = db.mapped_column(db.ForeignKey("recipient.id"))
     recipient: db.Mapped["Recipient"] = db.relationship(back_populates="donations")
     donation_type_id: db.Mapped[int] = db.mapped_column(
-        db.ForeignKey("donation_type.id")
+        db.ForeignKey("donation_type.id"), index=True
     )
     donation_type: db.Mapped["DonationType"] = db.relationship(
         back_populates="donations"
     )
     value = db.mapped_column(db.Float, index=True)
     date = db.mapped_column(db.Date, index=True)
-    ec_ref = db.mapped_column(db.String(8))
+    ec_ref = db.mapped_column(db.String(8), index=True, unique=True)
     is_legacy = db.mapped_column(db.Boolean, index=True)
 
+    # Serves both a recipient's donations and those donations in date order. In SQLite,
+    # every index ends with the row's ID, so the single column indexes above already
+    # sort ties on date or value by ID.
+    __table_args__ = (db.Index("ix_donation_recipient_id_date", recipient_id, date),)
+
     def __repr__(self):
         return f"<Donation of £{self.value} from {self.donor.name} to {self.recipient.name} on {self.date}>"
 
@@ -122,6 +140,95 @@ class Donation(db.Model):
         }
 
 
+class DonationMonth(db.Model):
+    """Donations summed by recipient, month, donor type, donation type and legacy status,
+    so that charts can be drawn without reading every donation. Rebuilt at the end of
+    each import; aliases aren't one of its dimensions, so editing them leaves it as is."""
+    __tablename__ = "donation_month"
+
+    id = db.mapped_column(db.Integer, primary_key=True)
+    recipient_id: db.Mapped[int] = db.mapped_column(db.ForeignKey("recipient.id"))
+    # The first day of the month
+    month = db.mapped_column(db.Date)
+    # Like Donor.donor_type_id, this holds the donor type's name
+    donor_type_id = db.mapped_column(db.String(25))
+    donation_type_id: db.Mapped[int] = db.mapped_column(
+        db.ForeignKey("donation_type.id")
+    )
+    is_legacy = db.mapped_column(db.Boolean)
+    total = db.mapped_column(db.Float)
+    count = db.mapped_column(db.Integer)
+    first_date = db.mapped_column(db.Date)
+    last_date = db.mapped_column(db.Date)
+
+    __table_args__ = (
+        db.Index("ix_donation_month_recipient_id_month", recipient_id, month),
+        db.Index("ix_donation_month_month", month),
+    )
+
+    @staticmethod
+    def summarise(*conditions):
+        """Selects the donations meeting conditions, summed into this table's columns"""
+        month = db.type_coerce(db.func.strftime("%Y-%m-01", Donation.date), db.Date)
+        dimensions = [
+            Donation.recipient_id,
+            month.label("month"),
+            Donor.donor_type_id,
+            Donation.donation_type_id,
+            Donation.is_legacy,
+        ]
+        return (
+            db.select(
+                *dimensions,
+                db.func.sum(Donation.value).label("total"),
+                db.func.count().label("count"),
+                db.func.min(Donation.date).label("first_date"),
+                db.func.max(Donation.date).label("last_date"),
+            )
+            .join(Donor, Donation.donor_id == Donor.id)
+            .where(*conditions)
+            .group_by(*dimensions)
+        )
+
+    @staticmethod
+    def rebuild():
+        """Replaces the table's contents with sums of the current donations, to be
+        committed along with them"""
+        db.session.execute(db.delete(DonationMonth))
+        summary = DonationMonth.summarise()
+        columns = [column.name for column in summary.selected_columns]
+        db.session.execute(
+            db.insert(DonationMonth).from_select(columns, summary)
+        )
+
+
+class AliasTotal(db.Model):
+    """Each alias's donations, excluding the types left out of the charts, summed across
+    all recipients (with no recipient) and for each recipient. Rebuilt at the end of each
+    import and refreshed for the aliases affected whenever aliases change."""
+    __tablename__ = "alias_total"
+
+    id = db.mapped_column(db.Integer, primary_key=True)
+    donor_alias_id: db.Mapped[int] = db.mapped_column(
+        db.ForeignKey("donor_alias.id"), index=True
+    )
+    recipient_id: db.Mapped[int] = db.mapped_column(
+        db.ForeignKey("recipient.id"), nullable=True
+    )
+    total = db.mapped_column(db.Float)
+    donation_count = db.mapped_column(db.Integer)
+    first_gift = db.mapped_column(db.Date)
+    latest_gift = db.mapped_column(db.Date)
+    # The name of the type of the alias's donors who gave the most, as in
+    # Donor.donor_type_id
+    donor_type_id = db.mapped_column(db.String(25))
+
+    # Leaderboards are read in order from here
+    __table_args__ = (
+        db.Index("ix_alias_total_recipient_id_total", recipient_id, total),
+    )
+
+
 class User(UserMixin, db.Model):
     __tablename__ = "user"
     id = db.mapped_column(db.Integer, primary_key=True)
@@ -156,18 +263,14 @@ class User(UserMixin, db.Model):
         return task
 
     def get_tasks_in_progress(self):
-        return db.session.scalars(
+        tasks = db.session.scalars(
             db.select(Task).where(Task.user == self).where(Task.complete == None)
         ).all()
+        return [task for task in tasks if not task.is_interrupted()]
 
     def get_task_in_progress(self):
-        try:
-            task = db.session.scalars(
-                db.select(Task).where(Task.user == self).where(Task.complete == None)
-            ).one() 
-            return task
-        except:
-            return None
+        tasks = self.get_tasks_in_progress()
+        return tasks[0] if len(tasks) == 1 else None
             
     def add_notification(self, name, data):
         db.session.execute(db.delete(Notification).where(name == name))
@@ -203,6 +306,12 @@ class Task(db.Model):  # Store request context after request has vanished
         job = self.get_rq_job()
         return job.meta.get("progress", 0) if job is not None else 100
 
+    def is_interrupted(self):
+        """True if the task's job died before finishing, e.g. because its worker was
+        killed, so it will never mark itself complete"""
+        job = self.get_rq_job()
+        return job is None or job.get_status() in ("failed", "stopped", "canceled")
+
 class Notification(db.Model):
     __tablename__ = "notification"
     id = db.mapped_column(db.Integer, primary_key=True)
@@ -215,4 +324,177 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+
+class ImportWatermark(db.Model):
+    """The latest donation date reached by a successful import, plus the EC references
+    dated on that day, so that an incremental import can pick up where it left off"""
+    __tablename__ = "import_watermark"
+    id = db.mapped_column(db.Integer, primary_key=True)
+    date = db.mapped_column(db.Date)
+    ec_refs_json = db.mapped_column(db.Text)
+    timestamp = db.mapped_column(db.DateTime, default=dt.datetime.utcnow, index=True)
+
+    def get_ec_refs(self):
+        return set(json.loads(str(self.ec_refs_json)))
+
+    @staticmethod
+    def latest():
+        return db.session.scalars(
+            db.select(ImportWatermark).order_by(ImportWatermark.id.desc())
+        ).first()
+
+
+class ImportCheckpoint(db.Model):
+    """How far an unfinished import has got, so that relaunching it resumes rather than
+    starting again. The source is either a raw data file, identified by its hash, or a
+    download URL, which is resumed from the first uncommitted row. Deleted once the
+    import finishes."""
+    __tablename__ = "import_checkpoint"
+    id = db.mapped_column(db.Integer, primary_key=True)
+    source = db.mapped_column(db.Text)
+    source_hash = db.mapped_column(db.String(64))
+    incremental = db.mapped_column(db.Boolean, default=False)
+    rows = db.mapped_column(db.Integer, default=0)  # raw CSV records committed so far
+    timestamp = db.mapped_column(db.Float, index=True, default=time.time)
+    # The snapshot being made of a download
+    snapshot_id = db.mapped_column(db.ForeignKey("snapshot.id"))
+    snapshot: db.Mapped["Snapshot"] = db.relationship()
+
+    @staticmethod
+    def latest():
+        return db.session.scalars(
+            db.select(ImportCheckpoint).order_by(ImportCheckpoint.id.desc())
+        ).first()
+
+    @staticmethod
+    def abandon():
+        """Discards any unfinished import, so that the next one starts afresh. The
+        snapshot of an interrupted download is deleted along with its partial files. The
+        caller commits."""
+        for checkpoint in db.session.scalars(db.select(ImportCheckpoint)).all():
+            if checkpoint.snapshot is not None:
+                checkpoint.snapshot.delete_files()
+                db.session.delete(checkpoint.snapshot)
+            db.session.delete(checkpoint)
+
+
+class Snapshot(db.Model):
+    """A download from the Electoral Commission. The raw CSV is kept gzipped for auditing,
+    alongside an archive of its normalised batches which can be imported again without
+    re-parsing it. The hash of each batch lets the next import skip batches which this
+    one has already imported."""
+    __tablename__ = "snapshot"
+    id = db.mapped_column(db.Integer, primary_key=True)
+    date = db.mapped_column(db.Date, index=True)
+    # Whether records covered by a watermark were left out of the import
+    incremental = db.mapped_column(db.Boolean, default=False)
+    raw_filename = db.mapped_column(db.String(255))
+    archive_filename = db.mapped_column(db.String(255))
+    # Hash and size of the raw CSV, left empty if the download was interrupted
+    sha256 = db.mapped_column(db.String(64))
+    size = db.mapped_column(db.Integer)
+    batch_hashes_json = db.mapped_column(db.Text, default="[]")
+    imported = db.mapped_column(db.Boolean, default=False)
+
+    def get_batch_hashes(self):
+        return json.loads(str(self.batch_hashes_json))
+
+    def delete_files(self):
+        for filename in [self.raw_filename, self.archive_filename]:
+            if filename and os.path.exists(filename):
+                os.remove(filename)
+
+    @staticmethod
+    def latest(archived=False, full=False):
+        """The last snapshot to be imported, optionally only those with an archive or
+        those of every donation"""
+        query = db.select(Snapshot).where(Snapshot.imported == True)
+        if archived:
+            query = query.where(Snapshot.archive_filename != None)
+        if full:
+            query = query.where(Snapshot.incremental == False)
+        return db.session.scalars(query.order_by(Snapshot.id.desc())).first()
+
+class DatasetState(db.Model):
+    """A single row describing the donation dataset as a whole. Its version is bumped
+    whenever donations are imported or aliases change, so cached results can be keyed on
+    it. Row counts and the range of donation dates are recorded at the same time, so
+    pages can check them without reading the tables."""
+    __tablename__ = "dataset_state"
+    id = db.mapped_column(db.Integer, primary_key=True)
+    version = db.mapped_column(db.Integer, default=0)
+    updated = db.mapped_column(db.DateTime, default=dt.datetime.utcnow)
+    imported = db.mapped_column(db.DateTime)
+    donations = db.mapped_column(db.Integer)
+    donors = db.mapped_column(db.Integer)
+    aliases = db.mapped_column(db.Integer)
+    first_donation = db.mapped_column(db.Date)
+    last_donation = db.mapped_column(db.Date)
+    # Whether filter slugs, monthly summaries and alias totals have been derived from the
+    # donations. Empty on databases imported before those were added.
+    derived = db.mapped_column(db.Boolean)
+
+    @staticmethod
+    def current():
+        """Returns the state, or a blank one if nothing has been imported yet. Donations
+        which were imported before their derived data was added have it derived first."""
+        state = db.session.get(DatasetState, 1)
+        if state is None or not state.derived:
+            if db.session.scalar(db.select(Donation.id).limit(1)) is not None:
+                state = DatasetState.derive()
+            else:
+                state = state or DatasetState(version=0)
+                state.count()
+        if state.id is not None and has_app_context():
+            # Holding on to the state keeps it in the session's identity map, so looking
+            # it up again in the same request doesn't query the database
+            g.dataset_state = state
+        return state
+
+    @staticmethod
+    def derive():
+        """Fills in the filter slugs, monthly summaries and alias totals of donations
+        imported before they were added, which would otherwise be missing until the next
+        import, and moves on to a new version. Commits."""
+        from app import totals  # totals imports the main routes, which import models
+
+        for model in [DonationType, DonorType, Recipient]:
+            totals.fill_slugs(model)
+        DonationMonth.rebuild()
+        totals.rebuild()
+        state = DatasetState.bump()
+        state.derived = True
+        db.session.commit()
+        return state
+
+    @staticmethod
+    def bump(imported=False):
+        """Moves on to a new version and recounts the dataset, to be committed along with
+        the change. imported records the change as an import, which derives everything
+        from the donations again."""
+        state = db.session.get(DatasetState, 1)
+        if state is None:
+            state = DatasetState(id=1, version=0)
+            db.session.add(state)
+        state.version += 1
+        state.updated = dt.datetime.utcnow()
+        if imported:
+            state.imported = state.updated
+            state.derived = True
+        state.count()
+        return state
+
+    def count(self):
+        """Records the number of donations, donors and aliases and the range of donation
+        dates"""
+        self.donations, self.first_donation, self.last_donation = db.session.execute(
+            db.select(
+                db.func.count(Donation.id),
+                db.func.min(Donation.date),
+                db.func.max(Donation.date),
+            )
+        ).one()
+        self.donors = db.session.scalar(db.select(db.func.count(Donor.id)))
+        self.aliases = db.session.scalar(db.select(db.func.count(DonorAlias.id)))
+
 # TODO: donation makeup bar chart, comparative. Only needs to be annual.
@@ -0,0 +1,166 @@
+import re
+import weakref
+
+from sqlalchemy import event
+
+from app import db
+from app.models import Donation, Donor, DonorAlias, Recipient
+
+# Alias, original donor and recipient names are indexed in SQLite FTS5 tables, one row
+# per name with the same rowid as the name's record, so that searching doesn't scan
+# every alias. The tables live outside the models' metadata: create_all makes them
+# through the DDL below, and sync() makes them on databases created by migrations.
+TOKENIZER = "unicode61 remove_diacritics 2"
+INDEXED_MODELS = [DonorAlias, Donor, Recipient]
+FTS_TABLES = {
+    model: db.table(
+        f"{model.__tablename__}_fts",
+        db.column("rowid"),
+        db.column("name"),
+        db.column("rank"),
+    )
+    for model in INDEXED_MODELS
+}
+
+
+def create_table_ddl(fts):
+    return db.DDL(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts.name} "
+        f"USING fts5(name, tokenize='{TOKENIZER}')"
+    )
+
+
+for fts in FTS_TABLES.values():
+    event.listen(
+        db.metadata, "after_create", create_table_ddl(fts).execute_if(dialect="sqlite")
+    )
+    event.listen(
+        db.metadata,
+        "before_drop",
+        db.DDL(f"DROP TABLE IF EXISTS {fts.name}").execute_if(dialect="sqlite"),
+    )
+
+
+def include_name(name, type_, parent_names):
+    """Keeps the search tables, and the shadow tables FTS5 makes for them, out of
+    autogenerated migrations"""
+    if type_ == "table":
+        return not any(name.startswith(fts.name) for fts in FTS_TABLES.values())
+    return True
+
+
+# Engines whose databases have been found to have the search tables
+AVAILABLE = weakref.WeakSet()
+
+
+def forget_tables(metadata, connection, **kwargs):
+    AVAILABLE.discard(connection.engine)
+
+
+event.listen(db.metadata, "after_drop", forget_tables)
+
+
+def available():
+    """Whether the search tables exist. Once they've been found, that's remembered for
+    the engine, so searches don't inspect the database each time."""
+    if db.engine in AVAILABLE:
+        return True
+    if db.engine.dialect.name == "sqlite" and all(
+        db.inspect(db.engine).has_table(fts.name) for fts in FTS_TABLES.values()
+    ):
+        AVAILABLE.add(db.engine)
+        return True
+    return False
+
+
+def sync(*models):
+    """Brings the search tables for models, by default all of them, into line with the
+    names they index, creating them if need be. Only rows whose name has changed are
+    rewritten. The caller commits."""
+    if db.engine.dialect.name != "sqlite":
+        return  # pragma: no cover
+    db.session.flush()
+    for model in models or INDEXED_MODELS:
+        fts = FTS_TABLES[model]
+        db.session.execute(create_table_ddl(fts))
+        stale = (
+            db.select(fts.c.rowid)
+            .outerjoin(model, model.id == fts.c.rowid)
+            .where(model.name.is_distinct_from(fts.c.name))
+        )
+        db.session.execute(db.delete(fts).where(fts.c.rowid.in_(stale)))
+        missing = (
+            db.select(model.id, model.name)
+            .outerjoin(fts, fts.c.rowid == model.id)
+            .where(fts.c.rowid.is_(None), model.name.is_not(None))
+        )
+        db.session.execute(
+            db.insert(fts).from_select([fts.c.rowid, fts.c.name], missing)
+        )
+
+
+def match_expression(search):
+    """Makes an FTS5 query for names containing each word of search, or a word starting
+    with it. Returns None if search has no words."""
+    words = re.findall(r"\w+", search)
+    return " ".join(f'"{word}"*' for word in words) or None
+
+
+def matches(model, terms):
+    fts = FTS_TABLES[model]
+    return db.select(fts.c.rowid, fts.c.rank).where(
+        db.literal_column(fts.name).op("MATCH")(terms)
+    )
+
+
+def search_donations(query, search):
+    """Filters a donations query to those whose alias, original donor or recipient name
+    matches search. Falls back to a substring match on alias names if the search tables
+    aren't available."""
+    terms = match_expression(search)
+    if terms is None or not available():
+        return query.where(DonorAlias.name.ilike(f"%{search}%"))
+
+    def ids(model):
+        return matches(model, terms).with_only_columns(FTS_TABLES[model].c.rowid)
+
+    donors = db.select(Donor.id).where(
+        db.or_(Donor.id.in_(ids(Donor)), Donor.donor_alias_id.in_(ids(DonorAlias)))
+    )
+    return query.where(
+        db.or_(Donation.donor_id.in_(donors), Donation.recipient_id.in_(ids(Recipient)))
+    )
+
+
+def order_by_relevance(query, search):
+    """Sorts a query from search_donations by how well each donation's names match,
+    best first, then by date, then by ID so that ties always come back in the same
+    order"""
+    terms = match_expression(search)
+    if terms is None or not available():
+        return query.order_by(Donation.date.desc(), Donation.id.desc())
+    # Each donation's rank is the sum of the bm25 ranks of its matching names, which are
+    # negative and lower for better matches. Ranks are gathered starting from the
+    # matching names, so the work depends on the number of matches, not donations.
+    alias, donor, recipient = [
+        matches(model, terms).subquery() for model in INDEXED_MODELS
+    ]
+    ranks = db.union_all(
+        db.select(Donation.id, alias.c.rank)
+        .join(Donor, Donor.donor_alias_id == alias.c.rowid)
+        .join(Donation, Donation.donor_id == Donor.id),
+        db.select(Donation.id, donor.c.rank).join(
+            Donation, Donation.donor_id == donor.c.rowid
+        ),
+        db.select(Donation.id, recipient.c.rank).join(
+            Donation, Donation.recipient_id == recipient.c.rowid
+        ),
+    ).subquery()
+    relevance = (
+        db.select(ranks.c.id, db.func.sum(ranks.c.rank).label("rank"))
+        .group_by(ranks.c.id)
+        .subquery()
+    )
+    return query.join(relevance, relevance.c.id == Donation.id).order_by(
+        relevance.c.rank, Donation.date.desc(), Donation.id.desc()
+    )
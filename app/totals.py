@@ -0,0 +1,78 @@
+from app import db
+from app.main.routes import OTHER_DONATION_TYPE_SLUGS, OTHER_DONOR_TYPE_SLUGS, slug_filter
+from app.db_import.normalise import FILTER_PARTIES, slugify
+from app.models import AliasTotal, Donation, Donor, DonationType, DonorType, Recipient
+
+
+def fill_slugs(model):
+    """Sets the filter slugs of a model's records which don't have them yet, and whether
+    recipients are main parties"""
+    for record in db.session.scalars(db.select(model).where(model.slug == None)):
+        record.slug = slugify(record.name)
+        if model == Recipient:
+            record.is_main_party = record.name in FILTER_PARTIES
+
+
+def summarise(by_recipient, *conditions):
+    """Selects the rows of AliasTotal for the donations meeting conditions, either for
+    each recipient or across all of them"""
+    dimensions = [Donor.donor_alias_id]
+    if by_recipient:
+        dimensions.append(Donation.recipient_id)
+    other_donation_types = slug_filter(
+        OTHER_DONATION_TYPE_SLUGS, DonationType, DonationType.id
+    )
+    other_donor_types = slug_filter(OTHER_DONOR_TYPE_SLUGS, DonorType, DonorType.name)
+    by_type = (
+        db.select(
+            *dimensions,
+            Donor.donor_type_id,
+            db.func.sum(Donation.value).label("total"),
+            db.func.count().label("donation_count"),
+            db.func.min(Donation.date).label("first_gift"),
+            db.func.max(Donation.date).label("latest_gift"),
+        )
+        .join(Donor, Donation.donor_id == Donor.id)
+        .where(Donation.donation_type_id.not_in(other_donation_types))
+        .where(Donor.donor_type_id.not_in(other_donor_types))
+        .where(*conditions)
+        .group_by(*dimensions, Donor.donor_type_id)
+        .subquery()
+    )
+
+    # Each group's totals go on the row of its donor type which gave the most
+    group = [by_type.c[column.key] for column in dimensions]
+    ranked = db.select(
+        by_type.c.donor_alias_id,
+        by_type.c.recipient_id if by_recipient else db.null().label("recipient_id"),
+        db.func.sum(by_type.c.total).over(partition_by=group).label("total"),
+        db.func.sum(by_type.c.donation_count)
+        .over(partition_by=group)
+        .label("donation_count"),
+        db.func.min(by_type.c.first_gift).over(partition_by=group).label("first_gift"),
+        db.func.max(by_type.c.latest_gift)
+        .over(partition_by=group)
+        .label("latest_gift"),
+        by_type.c.donor_type_id,
+        db.func.row_number()
+        .over(partition_by=group, order_by=by_type.c.total.desc())
+        .label("rank"),
+    ).subquery()
+    return db.select(
+        *[column for column in ranked.c if column.name != "rank"]
+    ).where(ranked.c.rank == 1)
+
+
+def rebuild(alias_ids=None):
+    """Recalculates the totals of the aliases with alias_ids, by default all of them. The
+    caller commits."""
+    db.session.flush()
+    conditions, stale = [], db.delete(AliasTotal)
+    if alias_ids is not None:
+        conditions.append(Donor.donor_alias_id.in_(alias_ids))
+        stale = stale.where(AliasTotal.donor_alias_id.in_(alias_ids))
+    db.session.execute(stale)
+    for by_recipient in [False, True]:
+        summary = summarise(by_recipient, *conditions)
+        columns = [column.name for column in summary.selected_columns]
+        db.session.execute(db.insert(AliasTotal).from_select(columns, summary))
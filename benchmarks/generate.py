@@ -0,0 +1,199 @@
+"""Generates synthetic donation registers in the Electoral Commission's CSV format, for
+benchmarking the importer. Usage:
+
+    python -m benchmarks.generate ROWS FILENAME [--donors N] [--recipients N] [--seed N]
+"""
+
+from datetime import date, timedelta
+import argparse
+import csv
+import random
+
+HEADER = [
+    "\ufeffECRef",
+    "RegulatedEntityName",
+    "RegulatedEntityType",
+    "Value",
+    "AcceptedDate",
+    "AccountingUnitName",
+    "DonorName",
+    "AccountingUnitsAsCentralParty",
+    "IsSponsorship",
+    "DonorStatus",
+    "RegulatedDoneeType",
+    "CompanyRegistrationNumber",
+    "Postcode",
+    "DonationType",
+    "NatureOfDonation",
+    "PurposeOfVisit",
+    "DonationAction",
+    "ReceivedDate",
+    "ReportedDate",
+    "IsReportedPrePoll",
+    "ReportingPeriodName",
+    "IsBequest",
+    "IsAggregation",
+    "RegulatedEntityId",
+    "AccountingUnitId",
+    "DonorId",
+    "CampaigningName",
+    "RegisterName",
+    "IsIrishSource",
+]
+
+MAIN_PARTIES = [
+    "Conservative and Unionist Party",
+    "Labour Party",
+    "Liberal Democrats",
+    "Scottish National Party (SNP)",
+    "Green Party",
+    "Reform UK",
+]
+
+# Rough shares of the real register
+DONOR_STATUSES = {
+    "Individual": 60,
+    "Company": 20,
+    "Trade Union": 6,
+    "Unincorporated Association": 5,
+    "Registered Political Party": 3,
+    "Public Fund": 2,
+    "Trust": 1,
+    "Limited Liability Partnership": 1,
+    "Friendly Society": 1,
+    "Other": 1,
+}
+DONATION_TYPES = {
+    "Cash": 80,
+    "Non Cash": 12,
+    "Public Funds": 4,
+    "Visit": 2,
+    "Permissible Donor Exempt Trust": 1,
+    "Impermissible Donor": 1,
+}
+FIRST_DATE = date(2001, 2, 16)
+LAST_DATE = date(2023, 12, 31)
+
+
+def choose(weights):
+    return random.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def make_recipients(count):
+    """The main parties, then minor parties, some of them since de-registered"""
+    recipients = MAIN_PARTIES[:count]
+    for number in range(len(recipients), count):
+        name = f"Minor Party {number}"
+        if number % 10 == 0:
+            year = random.randint(5, 22)
+            name += f" [De-registered {random.randint(1, 28):02}/06/{year:02}]"
+        recipients.append(name)
+    return recipients
+
+
+def make_donors(count):
+    """Donors with a fixed status, postcode and EC donor ID each"""
+    donors = []
+    for number in range(count):
+        status = choose(DONOR_STATUSES)
+        if status == "Individual":
+            name = f"{random.choice(['Mr', 'Mrs', 'Ms', 'Dr', 'Lord'])} Donor {number}"
+        elif status == "Company":
+            name = f"  Company {number}  Ltd "
+        else:
+            name = f"{status} {number}"
+        donors.append(
+            {
+                "DonorName": name,
+                "DonorStatus": status,
+                "CompanyRegistrationNumber": (
+                    str(random.randint(10**6, 10**8)) if status == "Company" else ""
+                ),
+                "Postcode": (
+                    "" if status == "Individual" else f"SW{random.randint(1, 20)} 1AA"
+                ),
+                "DonorId": str(number + 1),
+            }
+        )
+    return donors
+
+
+def make_record(number, recipients, donors):
+    """Returns a random record with its accepted date"""
+    # Most donations go to a few recipients from a few frequent donors
+    recipient_number = int(len(recipients) * random.random() ** 4)
+    donor = donors[int(len(donors) * random.random() ** 2)]
+    accepted = FIRST_DATE + timedelta(
+        days=random.randint(0, (LAST_DATE - FIRST_DATE).days)
+    )
+    received = accepted - timedelta(days=random.randint(0, 30))
+    election = random.random() < 0.03
+    nature = ""
+    donation_type = choose(DONATION_TYPES)
+    if donation_type == "Non Cash":
+        # Cells occasionally contain line breaks
+        nature = random.choice(["Office space", "Staff\r\ncosts", "Sponsorship"])
+    return accepted, {
+        "\ufeffECRef": f"C{number:07}",
+        "RegulatedEntityName": recipients[recipient_number],
+        "RegulatedEntityType": "Political Party",
+        "Value": f"£{random.lognormvariate(8.5, 1.2):,.2f}",
+        "AcceptedDate": accepted.strftime("%d/%m/%Y"),
+        "AccountingUnitName": (
+            "Central Party" if random.random() < 0.85 else f"Local Unit {number % 500}"
+        ),
+        "AccountingUnitsAsCentralParty": "False",
+        "IsSponsorship": "False",
+        "DonorStatus": (
+            "Unidentifiable Donor" if random.random() < 0.01 else donor["DonorStatus"]
+        ),
+        "DonationType": donation_type,
+        "NatureOfDonation": nature,
+        "DonationAction": random.choices(["", "Returned", "Forfeited"], [98, 1, 1])[0],
+        "ReceivedDate": "" if random.random() < 0.05 else received.strftime("%d/%m/%Y"),
+        "ReportedDate": (accepted + timedelta(days=60)).strftime("%d/%m/%Y"),
+        "ReportingPeriodName": (
+            f"Pre-Poll 1 - General Election {accepted.year}"
+            if election
+            else f"Q{(accepted.month - 1) // 3 + 1} {accepted.year}"
+        ),
+        "IsReportedPrePoll": str(election),
+        "IsBequest": str(random.random() < 0.005),
+        "IsAggregation": str(random.random() < 0.2),
+        "RegulatedEntityId": str(recipient_number + 1),
+        "RegisterName": "Great Britain",
+        "IsIrishSource": "False",
+        **{
+            field: donor[field]
+            for field in ["DonorName", "CompanyRegistrationNumber", "Postcode"]
+        },
+        "DonorId": donor["DonorId"],
+    }
+
+
+def generate(filename, rows, donors=None, recipients=350, seed=0):
+    """Writes a number of synthetic records to filename, newest first like the Electoral
+    Commission's export. The number of distinct donors defaults to a fifth of the
+    number of records."""
+    random.seed(seed)
+    recipient_names = make_recipients(recipients)
+    donor_records = make_donors(donors or max(rows // 5, 1))
+    records = [
+        make_record(number, recipient_names, donor_records) for number in range(rows)
+    ]
+    records.sort(key=lambda record: record[0], reverse=True)
+    with open(filename, "w", encoding="utf-8", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=HEADER, restval="")
+        writer.writeheader()
+        writer.writerows(record for _, record in records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("rows", type=int)
+    parser.add_argument("filename")
+    parser.add_argument("--donors", type=int)
+    parser.add_argument("--recipients", type=int, default=350)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.filename, args.rows, args.donors, args.recipients, args.seed)
@@ -0,0 +1,168 @@
+"""Benchmarks db_import against generated Electoral Commission CSVs, reporting records
+per second, peak memory, SQL statement count and time spent in each stage as JSON.
+Usage:
+
+    python -m benchmarks.import_benchmark [--rows N ...] [--donors N] [--recipients N]
+        [--output FILENAME]
+
+Each size is generated and imported into a fresh SQLite database in its own process,
+so that peak memory is measured separately.
+"""
+
+from datetime import datetime, timezone
+import argparse
+import collections
+import functools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import generate
+
+SIZES = [10_000, 100_000, 1_000_000]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed(function, stage, timings):
+    """Wraps function so that the time spent in it is added to timings[stage]"""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings[stage] += time.perf_counter() - start
+
+    return wrapper
+
+
+def run(filename, rows):
+    """Imports filename into a fresh database and returns the measurements"""
+    from sqlalchemy import event
+
+    from app import create_app, db, search, totals
+    from app.db_import import tasks
+    from app.models import DatasetState, Donation, DonationMonth, ImportCheckpoint
+    from config import Config
+
+    workdir = tempfile.mkdtemp(dir=os.path.dirname(filename))
+
+    class BenchmarkConfig(Config):
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(workdir, "benchmark.db")
+        CACHE_TYPE = "NullCache"
+        RAW_DATA_LOCATION = workdir + "/"
+        IMPORT_FILE = filename
+        DONATIONS_URL = None
+
+    app = create_app(BenchmarkConfig)
+    app.app_context().push()
+    db.create_all()
+
+    timings = collections.defaultdict(float)
+    tasks.normalise_batch = timed(tasks.normalise_batch, "normalise", timings)
+    tasks.BulkImporter.flush = timed(tasks.BulkImporter.flush, "merge", timings)
+    # What's derived from the donations once they're all in
+    search.sync = timed(search.sync, "search", timings)
+    DonationMonth.rebuild = timed(DonationMonth.rebuild, "monthly", timings)
+    totals.rebuild = timed(totals.rebuild, "totals", timings)
+    DatasetState.bump = timed(DatasetState.bump, "state", timings)
+    tasks.update_statistics = timed(tasks.update_statistics, "statistics", timings)
+    statements = 0
+
+    def count_statement(*args):
+        nonlocal statements
+        statements += 1
+
+    # An executemany counts as one statement
+    event.listen(db.engine, "before_cursor_execute", count_statement)
+
+    start = time.perf_counter()
+    tasks.db_import()
+    seconds = time.perf_counter() - start
+    # What's left is mostly reading and parsing the CSV
+    timings["read"] = seconds - sum(timings.values())
+
+    return {
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds),
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "statements": statements,
+        "stages": {stage: round(timing, 3) for stage, timing in timings.items()},
+        "donations": db.session.query(Donation).count(),
+        "succeeded": ImportCheckpoint.latest() is None,
+    }
+
+
+def version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--donors", type=int)
+    parser.add_argument("--recipients", type=int, default=350)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="defaults to standard output")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run(args.run, args.rows[0])))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for rows in args.rows:
+            filename = os.path.join(data_dir, f"raw_data_{rows}.csv")
+            generate(filename, rows, args.donors, args.recipients, args.seed)
+            process = subprocess.run(
+                [sys.executable, "-m", "benchmarks.import_benchmark"]
+                + ["--run", filename, "--rows", str(rows)],
+                cwd=ROOT,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            result = json.loads(process.stdout.splitlines()[-1])
+            result.update(
+                donors=args.donors or max(rows // 5, 1), recipients=args.recipients
+            )
+            results.append(result)
+            print(f"{rows} rows: {result['rows_per_second']} rows/s", file=sys.stderr)
+
+    report = json.dumps(
+        {
+            "version": version(),
+            "python": platform.python_version(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "results": results,
+        },
+        indent=2,
+    )
+    if args.output:
+        with open(args.output, "w") as outfile:
+            outfile.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,3 +15,13 @@ class Config(object):
     CACHE_TYPE = "FileSystemCache"
     CACHE_DIR = "./cache"
     REDIS_URL = os.environ.get("REDIS_URL") or "redis://localhost:6379"
+    RAW_DATA_LOCATION = os.environ.get("RAW_DATA_LOCATION") or "./db/"
+    # Overrides the Electoral Commission's CSV endpoint. Must include {from_date}, and
+    # {start} and {page_size} if the endpoint is paged
+    DONATIONS_URL = os.environ.get("DONATIONS_URL")
+    # Imports this raw CSV instead of downloading, e.g. to benchmark the importer
+    IMPORT_FILE = os.environ.get("IMPORT_FILE")
+    # Records committed per transaction during an import, and so per checkpoint
+    IMPORT_BATCH_SIZE = 5000
+    # Gzip versioned responses in the app, for when a reverse proxy doesn't compress them
+    COMPRESS_RESPONSES = os.environ.get("COMPRESS_RESPONSES", "true").lower() == "true"
@@ -1,14 +1,20 @@
 from app import create_app, db, cache
 from app.models import (
     User,
+    AliasTotal,
     DonorType,
     DonorAlias,
     Donor,
     Recipient,
     DonationType,
     Donation,
+    DonationMonth,
     Task,
     Notification,
+    ImportCheckpoint,
+    ImportWatermark,
+    Snapshot,
+    DatasetState,
 )
 
 app = create_app()
@@ -21,12 +27,18 @@ def make_shell_context():
         "db": db,
         "cache": cache,
         "User": User,
+        "AliasTotal": AliasTotal,
         "DonorType": DonorType,
         "DonorAlias": DonorAlias,
         "Donor": Donor,
         "Recipient": Recipient,
         "DonationType": DonationType,
         "Donation": Donation,
+        "DonationMonth": DonationMonth,
         "Task": Task,
         "Notification": Notification,
+        "ImportCheckpoint": ImportCheckpoint,
+        "ImportWatermark": ImportWatermark,
+        "Snapshot": Snapshot,
+        "DatasetState": DatasetState,
     }
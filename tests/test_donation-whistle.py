@@ -1,10 +1,21 @@
+import base64
+import csv
 import datetime as dt
 import dateutil.relativedelta as relativedelta
+import gzip
+import hashlib
+import http.server
 import json
 import os
+import plotly.graph_objects as go
+import re
 import rq
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
+import urllib.parse
 
 # Move up a directory to import app
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -14,10 +25,15 @@ sys.path.append(parent_dir)
 from config import Config
 from flask import current_app
 from flask_login import current_user
+from sqlalchemy import event
+from werkzeug.http import http_date
 
-from app import create_app, db
+from app import create_app, db, cache, search
 from app.models import (
     User,
+    AliasTotal,
+    DatasetState,
+    DonationMonth,
     Donation,
     DonorAlias,
     Donor,
@@ -25,10 +41,14 @@ from app.models import (
     DonationType,
     Recipient,
     Task,
+    ImportCheckpoint,
+    ImportWatermark,
+    Snapshot,
 )
 from app.models import load_user
 
-from app.db_import import tasks as db_import
+from app.db_import import archive, download, normalise, tasks as db_import
+from benchmarks import generate
 from app.api import routes as api
 from app.main import routes as main
 
@@ -38,6 +58,7 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = "sqlite://"
     WTF_CSRF_ENABLED = False
     RAW_DATA_LOCATION = "tests/"
+    IMPORT_FILE = "./tests/raw_data_2023-01-01.csv"
 
 
 class TestWebApp(unittest.TestCase):
@@ -218,41 +239,36 @@ class TestWebApp(unittest.TestCase):
             )
             assert db.session.scalars(db.select(Task)).first().get_progress() == 100
 
+    def fixture_record(self):
+        """The CSV header and the first record of the fixture, as a dictionary"""
+        with open("tests/raw_data_2023-01-01.csv", newline="") as infile:
+            header, first, *_ = db_import.csv.reader(infile)
+        return header, dict(zip(header, first))
+
     def test_relevancy_check(self):
-        dummy = {
-            "AccountingUnitName": "Central Party",
-            "DonorStatus": "Individual",
-            "DonationAction": "",
-            "ReportingPeriodName": "Q2 2023",
-        }
-        assert db_import.relevancy_check(dummy)
-        dummy["AccountingUnitName"] = "Mordor CLP"
-        assert not db_import.relevancy_check(dummy)
-        dummy["AccountingUnitName"] = "Central Party"
-        dummy["DonorStatus"] = "Unidentifiable Donor"
-        assert not db_import.relevancy_check(dummy)
-        dummy["DonorStatus"] = "Individual"
-        dummy["DonationAction"] = "Forfeited"
-        assert not db_import.relevancy_check(dummy)
-        dummy["DonationAction"] = ""
-        dummy["ReportingPeriodName"] = "Pre-poll 5 - Party (27/04/2015 - 03/05/2015)"
-        assert not db_import.relevancy_check(dummy)
+        header, record = self.fixture_record()
+
+        def relevant(**fields):
+            row = [{**record, **fields}[field] for field in header]
+            return len(normalise.normalise_batch(header, [row])["ec_ref"]) == 1
+
+        assert relevant(DonationAction="", ReportingPeriodName="Q2 2023")
+        assert not relevant(AccountingUnitName="Mordor CLP")
+        assert not relevant(DonorStatus="Unidentifiable Donor")
+        assert not relevant(DonationAction="Forfeited")
+        assert not relevant(
+            ReportingPeriodName="Pre-poll 5 - Party (27/04/2015 - 03/05/2015)"
+        )
 
     def test_remove_line_breaks(self):
-        dummy = {
-            "DonorName": """G1 GROUP PLC
-VIRGINIA HOUSE
-""",
-            "IsBequest": """TRUE
-            """,
-        }
-        db_import.remove_line_breaks(dummy)
-        assert dummy["DonorName"] == "G1 GROUP PLC VIRGINIA HOUSE "
-        assert (
-            dummy["IsBequest"]
-            == """TRUE
-            """
-        )
+        header, record = self.fixture_record()
+        record["DonorName"] = "G1 GROUP PLC\r\nVIRGINIA HOUSE\n"
+        record["Postcode"] = "G2\n5HH"
+        batch = normalise.normalise_batch(header, [list(record.values())])
+        assert batch["donor"] == ["G1 GROUP PLC VIRGINIA HOUSE"]
+        assert batch["postcode"] == ["G2 5HH"]
+        # Cells holding only TRUE or FALSE are left as they are
+        assert normalise.clean_column(["TRUE\n", "a\nb"]) == ["TRUE\n", "a b"]
 
     def test_last_download(self):
         self.login()
@@ -289,6 +305,289 @@ VIRGINIA HOUSE
         assert db.session.query(Donation).filter_by(ec_ref="C0476383").count() == 1
         db_import.add_missing_entries(DonorType)
 
+    def test_normalise_batch(self):
+        with open("tests/raw_data_2023-01-01.csv", newline="") as infile:
+            header, *rows = db_import.csv.reader(infile)
+        batch = normalise.normalise_batch(header, rows)
+        assert set(batch) == set(normalise.COLUMNS)
+        assert len(batch["ec_ref"]) == 16
+        assert batch["ec_ref"][0] == "C0479200"
+        assert batch["donor"][0] == "KGL (Estates) Ltd"
+        assert batch["value"][0] == 10000.0
+        assert batch["date"][0] == dt.date(2019, 12, 1)
+        assert "All For Unity" in batch["recipient"]
+        assert dt.date(2022, 5, 6) in batch["deregistered"]
+        assert "Exempt Trust" in batch["donation_type"]
+        assert normalise.normalise_batch(header, [])["ec_ref"] == []
+
+    def test_bulk_importer(self):
+        db_import.add_missing_entries(DonationType)
+        db_import.add_missing_entries(DonorType)
+        with open("tests/raw_data_2023-01-01.csv", newline="") as infile:
+            header, *rows = db_import.csv.reader(infile)
+        for _ in range(2):
+            importer = db_import.BulkImporter()
+            for start in range(0, len(rows), 4):
+                importer.add_batch(normalise.normalise_batch(header, rows[start : start + 4]))
+            importer.flush()
+        assert db.session.query(Donation).count() == 15
+        assert db.session.query(Donor).count() == 15
+        assert db.session.query(Recipient).count() == 7
+        donor = db.session.query(Donor).filter_by(name="Unite").first()
+        assert donor.donor_alias.name == "Unite"
+        assert db.session.query(Donation).filter_by(id=15).first().ec_ref == "ET0551995"
+
+    def serve_csv(self, served):
+        """Starts a local stand-in for the Electoral Commission's CSV endpoint, which
+        serves served["content"] and records the path of each request it receives. Given
+        start and rows parameters, it serves that page of records after the header, with
+        no more than served["cap"] records if set. While served["failures"] is positive,
+        it fails requests with a 503 instead."""
+        requests = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                requests.append(handler.path)
+                if served.get("failures", 0) > 0:
+                    served["failures"] -= 1
+                    handler.send_error(503)
+                    return
+                content = served["content"]
+                query = urllib.parse.parse_qs(urllib.parse.urlparse(handler.path).query)
+                if "rows" in query:
+                    start, rows = int(query["start"][0]), int(query["rows"][0])
+                    rows = min(rows, served.get("cap", rows))
+                    header, *records = content.rstrip(b"\n").split(b"\n")
+                    content = b"\n".join([header] + records[start : start + rows])
+                    content += b"\n"
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/csv")
+                handler.send_header("Content-Length", str(len(content)))
+                handler.end_headers()
+                handler.wfile.write(content)
+
+            def log_message(handler, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        raw_data_location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, raw_data_location)
+        self.app.config["RAW_DATA_LOCATION"] = raw_data_location + "/"
+        self.app.config["IMPORT_FILE"] = None
+        self.app.config["DONATIONS_URL"] = (
+            f"http://127.0.0.1:{server.server_port}/api/csv/Donations?from={{from_date}}"
+        )
+        return requests
+
+    def test_incremental_import(self):
+        with open("tests/raw_data_2023-01-01.csv", "rb") as infile:
+            fixture = infile.read()
+        served = {"content": fixture}
+        requests = self.serve_csv(served)
+        self.login()
+
+        db_import.db_import(incremental=True)
+        assert requests[-1].endswith("from=")
+        assert db.session.query(Donation).count() == 15
+        watermark = ImportWatermark.latest()
+        assert watermark.date == dt.date(2021, 6, 24)
+        assert watermark.get_ec_refs() == {"ET0551995"}
+
+        template = fixture.splitlines(keepends=True)[1]
+        new_donation = template.replace(b"C0479200", b"C9999991")
+        new_donation = new_donation.replace(b"01/12/2019", b"01/07/2021")
+        late_donation = template.replace(b"C0479200", b"C9999992")
+        served["content"] = fixture + new_donation + late_donation
+
+        db_import.db_import(incremental=True)
+        assert requests[-1].endswith("from=2021-06-24")
+        assert db.session.query(Donation).filter_by(ec_ref="C9999991").count() == 1
+        assert db.session.query(Donation).filter_by(ec_ref="C9999992").count() == 0
+        assert ImportWatermark.latest().date == dt.date(2021, 7, 1)
+
+        db_import.db_import()
+        assert requests[-1].endswith("from=")
+        assert db.session.query(Donation).filter_by(ec_ref="C9999992").count() == 1
+        assert db.session.query(Donation).count() == 17
+
+    def test_resumed_import(self):
+        with open("tests/raw_data_2023-01-01.csv", "rb") as infile:
+            fixture = infile.read()
+        # The eleventh record has a donation type the database doesn't know
+        records = fixture.splitlines(keepends=True)
+        records[11] = records[11].replace(b",Cash,", b",Gift,")
+        served = {"content": b"".join(records)}
+        requests = self.serve_csv(served)
+        self.app.config["DONATIONS_URL"] += "&start={start}&rows={page_size}"
+        self.app.config["IMPORT_BATCH_SIZE"] = 5
+        self.login()
+
+        db_import.db_import()
+        checkpoint = ImportCheckpoint.latest()
+        assert checkpoint.rows == 10
+        committed = db.session.query(Donation).count()
+        assert 0 < committed < 15
+        snapshot = checkpoint.snapshot
+        interrupted = [snapshot.raw_filename, snapshot.archive_filename]
+        response = self.client.get("/db_import/dl_and_import")
+        assert "An import was interrupted after 10 records" in response.text
+
+        served["content"] = fixture
+        first_request = len(requests)
+        db_import.db_import()
+        resumed = requests[first_request:]
+        assert any("start=10&" in request for request in resumed)
+        assert not any("start=0&" in request for request in resumed)
+        assert db.session.query(Donation).count() == 15
+        assert ImportCheckpoint.latest() is None
+        # The interrupted run's partial files are replaced by the rest of the download
+        snapshot = Snapshot.latest()
+        assert snapshot.raw_filename.endswith("_from_10.csv.gz")
+        assert snapshot.archive_filename is None
+        assert not any(os.path.exists(filename) for filename in interrupted)
+        with gzip.open(snapshot.raw_filename) as raw_file:
+            assert raw_file.read().endswith(fixture.splitlines(keepends=True)[-1])
+
+        # An interrupted import can be abandoned, along with its snapshot and files
+        served["content"] = b"".join(records)
+        db_import.db_import()
+        checkpoint = ImportCheckpoint.latest()
+        snapshot = checkpoint.snapshot
+        filenames = [snapshot.raw_filename, snapshot.archive_filename]
+        response = self.client.post(
+            "/db_import/dl_and_import", data={"abandon": "y"}, follow_redirects=True
+        )
+        assert "The interrupted import was abandoned" in response.text
+        assert ImportCheckpoint.latest() is None
+        assert db.session.query(Snapshot).count() == 1
+        assert not any(os.path.exists(filename) for filename in filenames)
+
+    def test_resumed_file_import(self):
+        self.login()
+        source = "./tests/raw_data_2023-01-01.csv"
+        db.session.add(
+            ImportCheckpoint(source=source, source_hash=db_import.file_hash(source), rows=20)
+        )
+        db.session.commit()
+        db_import.db_import()
+        # Only the donations after the twentieth record are imported
+        assert db.session.query(Donation).count() == 3
+        assert ImportCheckpoint.latest() is None
+
+        db.session.add(ImportCheckpoint(source=source, source_hash="0" * 64, rows=20))
+        db.session.commit()
+        db_import.db_import()
+        assert db.session.query(Donation).count() == 15
+
+    def test_snapshot(self):
+        with open("tests/raw_data_2023-01-01.csv", "rb") as infile:
+            fixture = infile.read()
+        self.serve_csv({"content": fixture})
+        self.login()
+        db_import.db_import()
+        snapshot = Snapshot.latest()
+        assert snapshot.sha256 == hashlib.sha256(fixture).hexdigest()
+        with gzip.open(snapshot.raw_filename) as raw_file:
+            assert raw_file.read() == fixture
+        response = self.client.get("/db_import/dl_and_import")
+        assert dt.date.today().strftime("%d %B %Y") in response.text
+        assert "again" in response.text
+
+        # Every batch of an unchanged download has been imported already, so a deleted
+        # donation isn't restored, and the download isn't kept
+        db.session.delete(db.session.query(Donation).first())
+        db.session.commit()
+        db_import.db_import()
+        assert db.session.query(Donation).count() == 14
+        assert db.session.query(Snapshot).count() == 1
+        assert len(os.listdir(self.app.config["RAW_DATA_LOCATION"])) == 2
+
+        # Importing a snapshot again doesn't resume an interrupted import
+        db.session.add(ImportCheckpoint(source="http://example.com", rows=5))
+        db.session.commit()
+        db_import.db_import(snapshot_id=snapshot.id)
+        assert db.session.query(Donation).count() == 15
+        assert ImportCheckpoint.latest() is None
+
+    def test_archive(self):
+        with open("tests/raw_data_2023-01-01.csv", newline="") as infile:
+            header, *rows = db_import.csv.reader(infile)
+        batch = normalise.normalise_batch(header, rows)
+        line = archive.encode_batch(batch, len(rows))
+        assert archive.decode_batch(line) == (batch, len(rows))
+
+    def test_generated_import(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            filename = os.path.join(data_dir, "raw_data_generated.csv")
+            generate.generate(filename, 500, donors=50, recipients=20)
+            with open(filename, newline="", encoding="utf-8") as infile:
+                header, *rows = db_import.csv.reader(infile)
+            assert header == generate.HEADER
+            assert len(rows) == 500
+            self.app.config["IMPORT_FILE"] = filename
+            self.login()
+            db_import.db_import()
+        assert 0 < db.session.query(Donation).count() < 500
+        assert db.session.query(Recipient).count() <= 20
+        assert db.session.query(Donor).count() <= 50
+        assert ImportCheckpoint.latest() is None
+
+    def test_paged_download(self):
+        with open("tests/raw_data_2023-01-01.csv", "rb") as infile:
+            fixture = infile.read()
+        served = {"content": fixture, "failures": 2}
+        requests = self.serve_csv(served)
+        url = self.app.config["DONATIONS_URL"].format(from_date="")
+        url += "&start={start}&rows={page_size}"
+        filename = self.app.config["RAW_DATA_LOCATION"] + "raw_data_audit.csv"
+        stream, infile = download.open_csv_stream(
+            url, filename, page_size=5, backoff=0, expected_size=len(fixture)
+        )
+        with infile:
+            records = list(db_import.csv.DictReader(infile))
+        assert len(records) == 22
+        assert records[0]["\ufeffECRef"] == "C0479200"
+        assert records[-1]["\ufeffECRef"] == "ET0551995"
+        assert stream.progress() == 1
+        stream.thread.join()
+        with open(filename, "rb") as audit_file:
+            assert audit_file.read() == fixture
+        assert any("start=20&rows=5" in request for request in requests)
+
+        # A server which serves fewer records than asked for is paged at its own size
+        served["cap"] = 3
+        stream, infile = download.open_csv_stream(url, filename, page_size=5, backoff=0)
+        with infile:
+            assert len(list(db_import.csv.DictReader(infile))) == 22
+        assert any("start=21&rows=3" in request for request in requests)
+        del served["cap"]
+
+        # A URL without paging fields is only requested once
+        requests.clear()
+        unpaged = self.app.config["DONATIONS_URL"].format(from_date="")
+        stream, infile = download.open_csv_stream(unpaged, filename, page_size=5)
+        with infile:
+            assert len(list(db_import.csv.DictReader(infile))) == 22
+        assert len(requests) == 1
+
+        served["failures"] = 10
+        stream, infile = download.open_csv_stream(url, filename, retries=1, backoff=0)
+        with self.assertRaises(download.urllib.error.HTTPError):
+            infile.read()
+
+    def test_progress_file(self):
+        source, infile = db_import.open_csv_file("tests/raw_data_2023-01-01.csv")
+        with infile:
+            assert source.progress() == 0
+            reader = db_import.csv.DictReader(infile)
+            assert next(reader)["\ufeffECRef"] == "C0479200"
+            assert 0 < source.progress() <= 1
+            assert len(list(reader)) == 21
+            assert source.progress() == 1
+
     def test_select_type_list(self):
         assert db_import.select_type_list(DonationType) == db_import.DONATION_TYPES
         assert db_import.select_type_list(DonorType) == db_import.DONOR_TYPES
@@ -335,6 +634,64 @@ VIRGINIA HOUSE
     def test_load_user(self):
         assert repr(load_user(1)) == "<User bob>"
 
+    def test_filter_slugs(self):
+        assert normalise.slugify("Scottish National Party (SNP)") == (
+            "scottish_national_party_snp"
+        )
+        self.db_import()
+        labour = db.session.query(Recipient).filter_by(name="Labour Party").first()
+        assert labour.slug == "labour_party" and labour.is_main_party
+        unity = db.session.query(Recipient).filter_by(name="All For Unity").first()
+        assert unity.slug == "all_for_unity" and not unity.is_main_party
+        non_cash = db.session.query(DonationType).filter_by(name="Non Cash").first()
+        assert non_cash.slug == "non_cash"
+
+        # Records from before slugs existed get them on the next import
+        labour.slug, labour.is_main_party = None, None
+        db.session.commit()
+        db_import.db_import()
+        assert labour.slug == "labour_party" and labour.is_main_party
+
+        response = self.client.get("/api/data?filter=recipient_all_for_unity")
+        assert json.loads(response.text)["total"] == 1
+        for alias in ["x", "%C2%B2", "99999999999999999999999"]:
+            response = self.client.get(f"/api/data?filter=donor_alias_{alias}")
+            assert json.loads(response.text)["total"] == 0
+
+    def test_parse_filters(self):
+        filters = main.DEFAULT_FILTERS.replace("filter=", "").split("&")
+        # Every recipient, legacy option and donation type but "other" is picked
+        assert api.parse_filters(filters) == {
+            "donor_type": [
+                "company",
+                "friendly_society",
+                "individual",
+                "limited_liability_partnership",
+                "trade_union",
+                "trust",
+                "unincorporated_association",
+            ],
+            "donation_type": ["cash", "exempt_trust", "non_cash", "visit"],
+        }
+        assert api.parse_filters(filters + ["donation_type_other"]) == {
+            "donor_type": api.parse_filters(filters)["donor_type"]
+        }
+        assert api.parse_filters(
+            ["date_gt_2019-1-5", "is_legacy_true", "donor_alias_4", "donor_alias_x"]
+        ) == {"date_gt": "2019-01-05", "is_legacy": ["true"], "donor_alias": [4]}
+
+        # Requests for the same donations share a cache entry
+        keys = []
+        for query_string in [
+            "filter=recipient_labour_party&filter=date_lt_2020-01-01&length=10",
+            "length=10&filter=date_lt_2020-1-1&filter=recipient_labour_party",
+        ]:
+            with self.app.test_request_context("/api/data?" + query_string):
+                keys.append(api.data_cache_key())
+        assert keys[0] == keys[1]
+        response = self.client.get("/api/data?filter=date_gt_yesterday")
+        assert response.status_code == 400
+
     def test_apply_sort(self):
         self.db_import()
         query = db.select(Donation).join(Donor).join(DonorAlias)
@@ -358,6 +715,26 @@ VIRGINIA HOUSE
             query = db.session.scalars(api.apply_sort(query))
             assert query.first().id == 4
 
+        # Later criteria break ties in earlier ones, and the ID breaks any left
+        response = self.client.get(
+            "/api/data", query_string={"sort": "+recipient,-value"}
+        )
+        return_data = json.loads(response.text)["data"]
+        keys = [(d["recipient"], -d["amount"]) for d in return_data]
+        assert keys == sorted(keys)
+        with self.app.test_request_context("/api/data?sort=-value,+date,-value"):
+            assert api.sort_keys() == [
+                (Donation.value, True),
+                (Donation.date, False),
+                (Donation.id, False),
+            ]
+        # Empty criteria are skipped
+        with self.app.test_request_context("/api/data?sort=-value,"):
+            assert api.sort_keys() == [(Donation.value, True), (Donation.id, True)]
+        for sort in [",", "-date,"]:
+            response = self.client.get("/api/data", query_string={"sort": sort})
+            assert response.status_code == 200
+
     def test_filters_search_sort_pagination(self):
         self.db_import()
 
@@ -419,6 +796,217 @@ VIRGINIA HOUSE
         assert len(return_data) == 2
         assert return_data[0]["recipient_id"] == 3
 
+    def test_columnar_format(self):
+        self.db_import()
+        for query_string in ["cursor=&length=4", "sort=donor"]:
+            response = self.client.get(f"/api/data?{query_string}")
+            rows = json.loads(response.text)
+            response = self.client.get(f"/api/data?{query_string}&format=columnar")
+            columnar = json.loads(response.text)
+            assert columnar["total"] == rows["total"]
+            assert columnar.get("next") == rows.get("next")
+            columns = dict(columnar["columns"])
+            for name, names in columnar["dictionaries"].items():
+                assert len(names) == len(set(names))
+                columns[name] = [names[code] for code in columns[name]]
+            assert len(columns["date"]) == len(rows["data"])
+            for i, row in enumerate(rows["data"]):
+                assert columns["date"][i] == dt.datetime.strptime(
+                    row.pop("date"), "%a, %d %b %Y %H:%M:%S %Z"
+                ).date().isoformat()
+                assert row == {name: columns[name][i] for name in row}
+        # Each name is sent once, in order of first appearance
+        codes = columnar["columns"]["recipient"]
+        assert len(codes) == 15
+        assert len(set(codes)) < 15
+        assert sorted(set(codes), key=codes.index) == list(range(len(set(codes))))
+
+    def test_api_statement_count(self):
+        self.db_import()
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute", count_statement)
+        counts = []
+        for length in [1, 15]:
+            cache.clear()
+            db.session.expire_all()
+            statements.clear()
+            response = self.client.get(f"/api/data?start=0&length={length}")
+            assert len(json.loads(response.text)["data"]) == length
+            counts.append(len(statements))
+        assert counts[0] == counts[1] <= 3
+
+    def test_cursor_pagination(self):
+        self.db_import()
+        # Values left blank in the register are NULL, which sorts before other values
+        db.session.execute(
+            db.update(Donation).where(Donation.id.in_([2, 7, 11])).values(value=None)
+        )
+        db.session.commit()
+        sorts = ["", "-date", "+value", "-value", "-donor", "+recipient,-date,+value"]
+        for sort in sorts + ["-value,+date", "+value,-date"]:
+            response = self.client.get(
+                "/api/data", query_string={"cursor": "", "length": 100, "sort": sort}
+            )
+            expected = json.loads(response.text)["data"]
+            assert len(expected) == 15
+            donations, cursor = [], ""
+            while cursor is not None:
+                response = self.client.get(
+                    "/api/data",
+                    query_string={"cursor": cursor, "length": 4, "sort": sort},
+                )
+                page = json.loads(response.text)
+                assert page["total"] == 15
+                donations.extend(page["data"])
+                cursor = page["next"]
+            assert donations == expected
+
+        for cursor in ["notacursor", "5", '["", ["notadate", 3]]', '["", [null, null]]']:
+            if cursor != "notacursor":
+                cursor = base64.urlsafe_b64encode(cursor.encode("utf-8")).decode("ascii")
+            response = self.client.get(f"/api/data?cursor={cursor}&length=4")
+            assert response.status_code == 400
+        response = self.client.get("/api/data?cursor=&length=4&sort=-donor")
+        cursor = json.loads(response.text)["next"]
+        response = self.client.get(f"/api/data?cursor={cursor}&length=4&sort=-date")
+        assert response.status_code == 400
+
+    def test_donation_count_cache(self):
+        self.db_import()
+        response = self.client.get("/api/data?filter=recipient_labour_party&length=2")
+        assert json.loads(response.text)["total"] == 3
+
+        # Later pages reuse the count, until the dataset version changes
+        labour = db.session.query(Recipient).filter_by(name="Labour Party").first()
+        db.session.delete(db.session.query(Donation).filter_by(recipient=labour).first())
+        db.session.commit()
+        response = self.client.get(
+            "/api/data?filter=recipient_labour_party&start=2&length=2"
+        )
+        assert json.loads(response.text)["total"] == 3
+        DatasetState.bump()
+        db.session.commit()
+        response = self.client.get(
+            "/api/data?filter=recipient_labour_party&start=1&length=1"
+        )
+        assert json.loads(response.text)["total"] == 2
+
+    def test_search(self):
+        self.db_import()
+        # Prefixes of recipient names match
+        response = self.client.get("/api/data?search=labo")
+        return_data = json.loads(response.text)
+        assert return_data["total"] == 3
+        assert {d["recipient"] for d in return_data["data"]} == {"Labour Party"}
+
+        # Closer matches come first
+        response = self.client.get("/api/data?search=unite")
+        return_data = json.loads(response.text)["data"]
+        assert [d["donor"] for d in return_data] == ["Unite", "Unite the Union"]
+
+        # Aliases are reindexed when edited, and original donor names still match
+        self.client.post(
+            '/alias/new?selected_donors=["11","4"]',
+            data={"alias_name": "Labour Affiliates", "note": ""},
+        )
+        response = self.client.get("/api/data?search=labour%20affil")
+        assert json.loads(response.text)["total"] == 2
+        response = self.client.get("/api/data?search=labour")
+        return_data = json.loads(response.text)["data"]
+        assert [d["donor"] for d in return_data][:2] == ["Labour Affiliates"] * 2
+        response = self.client.get("/api/data?search=the%20union")
+        return_data = json.loads(response.text)["data"]
+        assert [d["original_donor_name"] for d in return_data] == ["Unite the Union"]
+
+        # Donations that tie on relevance and date are ordered by ID
+        for terms in ["labour", ""]:
+            query = search.order_by_relevance(db.select(Donation.id), terms)
+            assert str(query).endswith("donation.id DESC")
+
+        # Once the search tables have been found, searches don't look for them again
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute", count_statement)
+        response = self.client.get("/api/data?search=conservative")
+        assert json.loads(response.text)["total"]
+        assert statements and not any("PRAGMA" in s for s in statements)
+        db.drop_all()
+        assert not search.available()
+        db.create_all()
+        assert search.available()
+
+    def test_export(self):
+        self.db_import()
+        response = self.client.get("/export?filter=recipient_labour_party")
+        assert response.status_code == 302
+        response = self.client.get(response.location)
+        assert response.mimetype == "text/csv"
+        assert "attachment; filename=donation_whistle_export_" in (
+            response.headers["Content-Disposition"]
+        )
+        rows = list(csv.DictReader(response.text.splitlines()))
+        assert list(rows[0]) == list(main.PRETTY_FIELD_NAMES.values())
+        assert len(rows) == 3
+        assert all(row["Recipient name"] == "Labour Party" for row in rows)
+        dates = [row["Donation date"] for row in rows]
+        assert dates == sorted(dates, reverse=True)
+        dt.date.fromisoformat(dates[0])
+
+        response = self.client.get("/api/export?format=ndjson&search=baxter")
+        assert response.mimetype == "application/x-ndjson"
+        records = [json.loads(line) for line in response.text.splitlines()]
+        assert len(records) == 1
+        assert records[0]["Donor name (alias)"] == "Mr Edward T Baxter"
+
+    def test_conditional_get(self):
+        self.db_import()
+        self.logout()
+        for url in ["/api/data?filter=recipient_labour_party", "/donors"]:
+            response = self.client.get(url)
+            etag, _ = response.get_etag()
+            assert response.status_code == 200
+            assert response.last_modified is not None
+            response = self.client.get(url, headers={"If-None-Match": f'"{etag}"'})
+            assert response.status_code == 304
+            assert response.data == b""
+            response = self.client.get(
+                url,
+                headers={
+                    "If-Modified-Since": http_date(dt.datetime.now(dt.timezone.utc))
+                },
+            )
+            assert response.status_code == 304
+
+        # Larger responses are gzipped for clients which accept it
+        response = self.client.get("/donors", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in response.vary
+        assert b"<html" in gzip.decompress(response.data)
+
+        # A new dataset version changes the validators
+        url = "/api/data?filter=recipient_labour_party"
+        etag, _ = self.client.get(url).get_etag()
+        DatasetState.bump()
+        db.session.commit()
+        response = self.client.get(url, headers={"If-None-Match": f'"{etag}"'})
+        assert response.status_code == 200
+        assert response.get_etag()[0] != etag
+
+        response = self.client.get("/alias/export")
+        assert response.mimetype == "application/json"
+        aliases = json.loads(response.text)
+        assert len(aliases) == 15
+        assert aliases[0]["donors"] == ["Ada Rosina Cook’s Will Trust"]
+
     def test_aliases(self):
         self.db_import()
 
@@ -605,7 +1193,7 @@ VIRGINIA HOUSE
             .join(Donation)
             .join(DonationType)
             .group_by(DonorAlias.name)
-            .order_by(db.desc("donations"))
+            .order_by(db.desc("donations"), DonorAlias.id.desc())
         )
 
         donor_type, relevant_types = main.assign_colours_to_donor_types(query, 1)
@@ -637,6 +1225,150 @@ VIRGINIA HOUSE
         self.db_import()
         response = self.client.get("/recipient/1", follow_redirects=True)
 
+        # The link to the recipient's donations filters on its slug
+        snp = db.session.scalars(
+            db.select(Recipient).where(Recipient.name == "Scottish National Party (SNP)")
+        ).one()
+        response = self.client.get(f"/recipient/{snp.id}")
+        filters = re.search(r'"(\?filter=recipient_[^"]*)"', response.text).group(1)
+        assert filters.startswith("?filter=recipient_scottish_national_party_snp&")
+        response = self.client.get("/api/data" + filters)
+        assert json.loads(response.text)["total"] == 1
+
+    def test_derived_data(self):
+        self.db_import()
+        queries = ["filter=recipient_labour_party", "filter=recipient_other"]
+        totals = [
+            json.loads(self.client.get("/api/data?" + query).text)["total"]
+            for query in queries
+        ]
+
+        # A database imported before slugs, summaries and totals were added
+        for model in [DonationType, DonorType, Recipient]:
+            db.session.execute(db.update(model).values(slug=None))
+        db.session.execute(db.update(Recipient).values(is_main_party=None))
+        db.session.execute(db.delete(DonationMonth))
+        db.session.execute(db.delete(AliasTotal))
+        db.session.execute(db.update(DatasetState).values(derived=None))
+        db.session.commit()
+        version = db.session.get(DatasetState, 1).version
+
+        # They're derived on the first read, rather than waiting for an import
+        response = self.client.get("/recipient/1")
+        assert response.status_code == 200
+        assert "?filter=recipient_None" not in response.text
+        state = DatasetState.current()
+        assert (state.derived, state.version) == (True, version + 1)
+        assert db.session.scalar(db.select(db.func.sum(DonationMonth.count))) == 15
+        assert db.session.scalar(db.select(db.func.count(AliasTotal.id)))
+        for query, total in zip(queries, totals):
+            response = self.client.get("/api/data?" + query)
+            assert json.loads(response.text)["total"] == total
+        assert 0 < totals[1] < 15
+
+    def test_donation_months(self):
+        self.db_import()
+        assert db.session.scalar(db.select(db.func.sum(DonationMonth.count))) == 15
+        for all_filters in [
+            [],
+            ["date_gt_2019-11-15"],
+            ["date_gt_2019-11-15", "date_lt_2020-01-06"],
+            ["date_gt_2019-12-01", "date_lt_2019-12-10"],
+        ]:
+            months = main.donation_months(all_filters)
+            query = db.select(
+                months.c.recipient_id,
+                months.c.donor_type_id,
+                db.func.sum(months.c.total),
+                db.func.sum(months.c.count),
+            ).group_by(months.c.recipient_id, months.c.donor_type_id)
+            expected = main.apply_date_filters(
+                db.select(
+                    Donation.recipient_id,
+                    Donor.donor_type_id,
+                    db.func.sum(Donation.value),
+                    db.func.count(),
+                )
+                .join(Donor)
+                .group_by(Donation.recipient_id, Donor.donor_type_id),
+                all_filters,
+            )
+            assert sorted(db.session.execute(query).all()) == sorted(
+                db.session.execute(expected).all()
+            )
+
+    def test_alias_totals(self):
+        self.db_import()
+
+        def check_totals():
+            other_donation_types = main.slug_filter(
+                main.OTHER_DONATION_TYPE_SLUGS, DonationType, DonationType.id
+            )
+            other_donor_types = main.slug_filter(
+                main.OTHER_DONOR_TYPE_SLUGS, DonorType, DonorType.name
+            )
+            for recipient in [None, Donation.recipient_id]:
+                group = [Donor.donor_alias_id] + ([recipient] if recipient else [])
+                expected = (
+                    db.select(
+                        *group,
+                        db.func.sum(Donation.value),
+                        db.func.count(),
+                        db.func.min(Donation.date),
+                        db.func.max(Donation.date),
+                    )
+                    .join(Donor)
+                    .where(Donation.donation_type_id.not_in(other_donation_types))
+                    .where(Donor.donor_type_id.not_in(other_donor_types))
+                    .group_by(*group)
+                )
+                columns = [AliasTotal.donor_alias_id]
+                columns += [AliasTotal.recipient_id] if recipient else []
+                totals = db.select(
+                    *columns,
+                    AliasTotal.total,
+                    AliasTotal.donation_count,
+                    AliasTotal.first_gift,
+                    AliasTotal.latest_gift,
+                ).where(
+                    AliasTotal.recipient_id.is_not(None)
+                    if recipient
+                    else AliasTotal.recipient_id.is_(None)
+                )
+                assert sorted(db.session.execute(totals).all()) == sorted(
+                    db.session.execute(expected).all()
+                )
+
+        check_totals()
+        self.client.post(
+            '/alias/new?selected_donors=["11","4","14"]',
+            data={"alias_name": "Unite the Union", "note": ""},
+        )
+        alias = db.session.scalars(
+            db.select(DonorAlias).filter_by(name="Unite the Union").order_by(
+                DonorAlias.id.desc()
+            )
+        ).first()
+        total = db.session.scalar(
+            db.select(AliasTotal.total).where(
+                AliasTotal.donor_alias_id == alias.id, AliasTotal.recipient_id == None
+            )
+        )
+        assert total == 2500 + 1565 + 6825
+        check_totals()
+        self.client.post(f"/alias/delete/{alias.id}/{alias.donors[0].id}")
+        check_totals()
+        self.client.post(f"/alias/delete/{alias.id}")
+        check_totals()
+
+        # The leaderboards read from the totals
+        self.logout()
+        response = self.client.get("/donors")
+        assert (
+            '[ ["Simon J Collins & Associates Limited", 10, "Company", 50000.0, '
+            '"2019-11-26", "2019-11-26"], ["Mr Geoff Roper", 6, '
+        ) in response.text
+
     def test_assign_colours_to_parties(self):
         assert (
             main.assign_colours_to_parties("Conservative and Unionist Party")
@@ -654,40 +1386,62 @@ VIRGINIA HOUSE
         response = self.client.get("/donors", follow_redirects=True)
         assert "<h1>All donors<br>" in response.text
 
-    def test_update_party_sums(self):
+    def test_charts(self):
         self.db_import()
-        parties = {}
-        start_date = (
-            db.session.query(db.func.min(Donation.date)).first()[0].replace(day=1)
-        )
+        cache.clear()
+        alias = db.session.get(DonorAlias, 1)
+        charts = [
+            main.recipients_content()[0],
+            main.donors_content()[0],
+            *main.recipient_charts(1, []),
+            *main.recipient_charts(1, ["date_gt_2020-01-01"]),
+            main.gifts_chart(alias.name),
+        ]
+        # Charts are the same text Plotly would make of them, template and all
+        for chart in charts:
+            figure = json.loads(chart)
+            assert figure["layout"].pop("template")
+            assert go.Figure(figure).to_json() == chart
+        assert "\\u003cextra\\u003e" in charts[0]
+
+        # Charts are cached until the dataset version changes
+        db.session.execute(db.delete(AliasTotal))
+        assert main.donors_content()[0] == charts[1]
+        DatasetState.bump()
+        assert main.donors_content()[0] != charts[1]
+        db.session.rollback()
+
+    def test_pivot(self):
+        self.db_import()
+        start_date = db.session.query(db.func.min(Donation.date)).first()[0]
         end_date = db.session.query(db.func.max(Donation.date)).first()[0]
-        date_series = []
-        while start_date < end_date:
-            date_series.append(start_date)
-            start_date += relativedelta.relativedelta(months=1)
+        date_series = main.generate_date_series(start_date, end_date)
+        assert date_series[0] == start_date.replace(day=1)
+        assert date_series[-1] == end_date.replace(day=1)
+        assert main.generate_date_series(dt.date(2019, 12, 31), dt.date(2020, 1, 1)) == [
+            dt.date(2019, 12, 1),
+            dt.date(2020, 1, 1),
+        ]
 
-        for key in main.MAIN_PARTIES:
-            parties[key] = [0 for i in range(0, len(date_series))]
         party_stats_query = (
             db.session.query(
                 Recipient.name,
-                db.func.strftime("%Y-%m", Donation.date).label("month"),
-                db.func.sum(Donation.value),
-                Recipient.id,
+                Donation.date,
+                Donation.value,
             )
             .join(Recipient)
-            .join(Donor)
-            .join(DonationType)
-            .group_by("month", Recipient.name)
             .all()
         )
-
-        for record in party_stats_query:
-            date = dt.datetime.strptime(record[1], "%Y-%m").date()
-            index = date_series.index(date)
-            parties = main.update_party_sums(
-                parties, index, record[0], round(record[2], 2)
-            )
+        names, dates, values = zip(*party_stats_query)
+        totals = main.pivot(
+            names,
+            main.month_offsets(dates, start_date),
+            values,
+            main.MAIN_PARTIES,
+            len(date_series),
+        )
+        # Parties not in the list are added up in the last row
+        parties = dict(zip(main.MAIN_PARTIES, totals.round(2).tolist()))
         assert parties == {
             "Conservative and Unionist Party": [
                 50000.0,
@@ -811,3 +1565,51 @@ VIRGINIA HOUSE
         self.logout()
         response = self.client.get("recipient/1")
         assert "An administrator needs to set up aliases, otherwise" in response.text
+
+        # The check reads the counts the alias routes keep up to date
+        self.login()
+        self.client.post(
+            '/alias/new?selected_donors=["11","4","14"]',
+            data={"alias_name": "Unite the Union"},
+        )
+        assert DatasetState.current().aliases == db.session.scalar(
+            db.select(db.func.count(DonorAlias.id))
+        )
+        response = self.client.get("recipient/1")
+        assert "Set up aliases (see navigation bar above)" not in response.text
+
+    def test_dataset_state(self):
+        state = DatasetState.current()
+        assert (state.version, state.donations, state.imported) == (0, 0, None)
+        self.db_import()
+        state = DatasetState.current()
+        assert state.imported == state.updated
+        counts = [
+            db.session.scalar(db.select(db.func.count(model.id)))
+            for model in [Donation, Donor]
+        ]
+        assert [state.donations, state.donors] == counts
+        assert state.aliases == state.donors
+        dates = db.session.execute(
+            db.select(db.func.min(Donation.date), db.func.max(Donation.date))
+        ).one()
+        assert (state.first_donation, state.last_donation) == tuple(dates)
+
+        # Pages check for donations and aliases without reading the tables
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute", count_statement)
+        self.logout()
+        cache.clear()
+        db.session.expire_all()
+        response = self.client.get("/donors")
+        assert "<h1>All donors<br>" in response.text
+        assert not [
+            statement
+            for statement in statements
+            if re.search(r"FROM (donor|donation)\b", statement)
+        ]